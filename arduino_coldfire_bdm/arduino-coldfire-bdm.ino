@@ -17,6 +17,21 @@ int BKPT = 4; // Low = 1, High = 0
 int DSO = 5;
 int RESET = 7;
 
+// Commands supported beyond the basic set (P, B, R, S, s, r), one character
+// each. These are listed on the "Ready" line at startup, so that the host
+// can fall back to the basic commands when talking to an older sketch:
+//  M: send multiple packets in one message, receiving one response
+//  C: read-modify-write the debug CSR without a round-trip to the host
+//  W: write consecutive words to a Flash chip in unlock bypass mode
+//  F: as with W, but waiting for the Flash chip to finish programming each word
+//  D: read consecutive words from memory
+//  A: as with D, but returning only the data of each word
+//  V: verify that consecutive words of memory match a pattern
+//  T: test a range of RAM by writing each longword's address to it
+//  G: as with T, but writing a generated pattern to each longword instead
+//  X: execute one instruction, then read the program counter and registers
+#define EXTENSIONS "MCWFDAVTGX"
+
 // Serial data is sent in 17-bit packets:
 //  Receive (by the Coldfire): [status] [16 bits of data]
 //  Send (to the Coldfire): [0] [16 bits of data]
@@ -90,19 +105,109 @@ void setup() {
   pinMode(DSI, OUTPUT);
   pinMode(DSO, INPUT);
 
-  Serial.println("Ready.");
+  Serial.println("Ready. Extensions: " EXTENSIONS);
 }
 
-uint16_t getNextTwoBytesFromUSB() {
-  while (!Serial.available()) {
-  }
-  uint16_t data = ((uint16_t)Serial.read()) << 8;
+uint8_t getNextByteFromUSB() {
   while (!Serial.available()) {
   }
-  data |= Serial.read();
+  return Serial.read();
+}
+
+uint16_t getNextTwoBytesFromUSB() {
+  uint16_t data = ((uint16_t)getNextByteFromUSB()) << 8;
+  data |= getNextByteFromUSB();
   return data;
 }
 
+uint32_t getNextFourBytesFromUSB() {
+  uint32_t data = ((uint32_t)getNextTwoBytesFromUSB()) << 16;
+  data |= getNextTwoBytesFromUSB();
+  return data;
+}
+
+// A "Not Ready" response (status 1, data 0x0000) is expected while a command's
+// operands are being sent; any other response with the status bit set is an error.
+bool isErrorPacket(Packet packet) { return packet.status && packet.data != 0x0000; }
+
+void writePacketToUSB(Packet packet) {
+  Serial.print(packet.status ? "Y" : "N");
+  Serial.write((char *)&packet.data, sizeof(packet.data));
+}
+
+// Commands that send multiple packets return a single response: that of the
+// first packet sent, or the first error thereafter.
+void keepFirstError(Packet &response, Packet packet) {
+  if (isErrorPacket(packet) && !isErrorPacket(response)) {
+    response = packet;
+  }
+}
+
+// Send a READ.W command for the given address, returning the response to its
+// first packet, or the first error thereafter (as with the 'M' command).
+Packet sendReadWordCommand(uint32_t address) {
+  uint16_t packets[3] = {0x1940, (uint16_t)(address >> 16), (uint16_t)address};
+  Packet response = {0, 0};
+  for (uint8_t i = 0; i < 3; i++) {
+    Packet packet = sendAndReceivePacket(packets[i]);
+    if (i == 0 || (isErrorPacket(packet) && !isErrorPacket(response))) {
+      response = packet;
+    }
+  }
+  return response;
+}
+
+// The number of times to poll a Flash chip while it programs a word before giving
+// up. Programming a word takes microseconds, while each poll takes much longer.
+#define FLASH_PROGRAM_POLL_LIMIT 100
+
+// Poll a Flash chip after writing `data` to `address`, until it finishes
+// programming the word ("Data# Polling"): until then, bit 7 of the word read
+// back is the complement of bit 7 of the data written. Returns false if the
+// chip reports that programming failed (by setting bit 5), if it doesn't
+// finish in time, or if an error response is received (which is kept in
+// `response`, as with 'M').
+bool waitForFlashProgram(uint32_t address, uint16_t data, Packet &response) {
+  bool exceededTimeLimit = false;
+  for (uint8_t i = 0; i < FLASH_PROGRAM_POLL_LIMIT; i++) {
+    keepFirstError(response, sendReadWordCommand(address));
+    Packet value = receivePacket();
+    keepFirstError(response, value);
+    if (isErrorPacket(response)) {
+      return false;
+    }
+    if (((value.data ^ data) & 0x80) == 0) {
+      return true;
+    }
+    // Bit 5 may be set just as programming finishes, so only give up if bit 7
+    // still doesn't match on the read after it was set:
+    if (exceededTimeLimit) {
+      return false;
+    }
+    exceededTimeLimit = value.data & 0x20;
+  }
+  return false;
+}
+
+// The patterns that 'G' can write to each longword of memory, given its address
+// and a 32-bit value. (These match MemoryTestPattern in serial_interface.py.)
+#define TEST_PATTERN_ADDRESS 0  // The longword's own address (as with 'T')
+#define TEST_PATTERN_CONSTANT 1 // The value itself
+#define TEST_PATTERN_ROTATED 2  // The value, rotated left by one bit per longword
+
+uint32_t getTestPatternValue(uint8_t pattern, uint32_t value, uint32_t address) {
+  switch (pattern) {
+  case TEST_PATTERN_CONSTANT:
+    return value;
+  case TEST_PATTERN_ROTATED: {
+    uint8_t shift = (address >> 2) & 31;
+    return shift ? (value << shift) | (value >> (32 - shift)) : value;
+  }
+  default:
+    return address;
+  }
+}
+
 void loop() {
   if (Serial.available() > 0) {
     int command = Serial.read();
@@ -119,9 +224,7 @@ void loop() {
       break;
     case 'S': { // for Send-and-Receive
       uint16_t data = getNextTwoBytesFromUSB();
-      Packet packet = sendAndReceivePacket(data);
-      Serial.print(packet.status ? "Y" : "N");
-      Serial.write((char *)&packet.data, sizeof(packet.data));
+      writePacketToUSB(sendAndReceivePacket(data));
       break;
     }
     case 's': { // for Send
@@ -129,9 +232,232 @@ void loop() {
       break;
     }
     case 'r': { // for Receive
-      Packet packet = receivePacket();
-      Serial.print(packet.status ? "Y" : "N");
-      Serial.write((char *)&packet.data, sizeof(packet.data));
+      writePacketToUSB(receivePacket());
+      break;
+    }
+    case 'M': { // for Multiple send-and-receives
+      // One count byte, then that many 16-bit packets. Only one response is
+      // returned: that of the first packet, or the first error thereafter.
+      uint8_t count = getNextByteFromUSB();
+      Packet response = {0, 0};
+      for (uint8_t i = 0; i < count; i++) {
+        Packet packet = sendAndReceivePacket(getNextTwoBytesFromUSB());
+        if (i == 0 || (isErrorPacket(packet) && !isErrorPacket(response))) {
+          response = packet;
+        }
+      }
+      writePacketToUSB(response);
+      break;
+    }
+    case 'C': { // for CSR read-modify-write
+      // Two 32-bit masks follow; the CSR is set to (CSR & first) | second. As with
+      // 'M', only one response is returned: that of the first packet sent, or the
+      // first error thereafter. The CSR is not written if it could not be read.
+      uint32_t andMask = getNextFourBytesFromUSB();
+      uint32_t orMask = getNextFourBytesFromUSB();
+
+      Packet response = sendAndReceivePacket(0x2D80); // RDMREG
+      Packet high = receivePacket();
+      Packet low = receivePacket();
+      if (isErrorPacket(high) || isErrorPacket(low)) {
+        if (!isErrorPacket(response)) {
+          response = isErrorPacket(high) ? high : low;
+        }
+        writePacketToUSB(response);
+        break;
+      }
+
+      uint32_t csr = ((((uint32_t)high.data) << 16) | low.data) & andMask | orMask;
+      uint16_t packets[3] = {0x2C80, (uint16_t)(csr >> 16), (uint16_t)csr}; // WDMREG
+      for (uint8_t i = 0; i < 3; i++) {
+        Packet packet = sendAndReceivePacket(packets[i]);
+        if (isErrorPacket(packet) && !isErrorPacket(response)) {
+          response = packet;
+        }
+      }
+      writePacketToUSB(response);
+      break;
+    }
+    case 'W':   // for Write to Flash
+    case 'F': { // for program Flash (and wait)
+      // A 32-bit address, a count byte, then that many 16-bit words to write to
+      // consecutive addresses of a Flash chip in unlock bypass mode. As with 'M',
+      // only one response is returned: that of the first packet sent, or the
+      // first error thereafter. With 'F', the chip is polled after each word is
+      // written; if programming fails, the response is an error response, and
+      // the remaining words are received but not written.
+      uint32_t address = getNextFourBytesFromUSB();
+      uint8_t count = getNextByteFromUSB();
+      Packet response = {0, 0};
+      bool failed = false;
+      for (uint8_t i = 0; i < count; i++) {
+        uint16_t data = getNextTwoBytesFromUSB();
+        if (failed) {
+          continue;
+        }
+        uint16_t packets[8] = {
+            0x1840, 0x0000, 0x0000, 0x00A0, // WRITE.W 0xA0 to 0x00000000
+            0x1840, (uint16_t)(address >> 16), (uint16_t)address, data, // WRITE.W data
+        };
+        for (uint8_t j = 0; j < 8; j++) {
+          Packet packet = sendAndReceivePacket(packets[j]);
+          if ((i == 0 && j == 0) || (isErrorPacket(packet) && !isErrorPacket(response))) {
+            response = packet;
+          }
+        }
+        if (command == 'F' && !waitForFlashProgram(address, data, response)) {
+          failed = true;
+          if (!isErrorPacket(response)) {
+            response = {1, 0x0001}; // An "Error" response
+          }
+        }
+        address += 2;
+      }
+      writePacketToUSB(response);
+      break;
+    }
+    case 'D': { // for Dump
+      // A 32-bit address and a 16-bit count (of at least 1) follow. That many
+      // consecutive words are read with READ.W and then DUMP.W, each sent while
+      // the previous word is shifted out. The first response is that of the
+      // READ.W command (as with 'M'), followed by one response per word.
+      uint32_t address = getNextFourBytesFromUSB();
+      uint16_t count = getNextTwoBytesFromUSB();
+      writePacketToUSB(sendReadWordCommand(address));
+      for (uint16_t i = 0; i < count; i++) {
+        // The last word is shifted out with a NOP, rather than another DUMP.W:
+        writePacketToUSB(sendAndReceivePacket(i + 1 < count ? 0x1D40 : 0x0000));
+      }
+      break;
+    }
+    case 'A': { // for Auto-incrementing read
+      // As with 'D', but rather than a response per word, only the data of each
+      // word is returned (as two big-endian bytes), followed by one response:
+      // that of the READ.W command, or the first error thereafter (as with 'M').
+      uint32_t address = getNextFourBytesFromUSB();
+      uint16_t count = getNextTwoBytesFromUSB();
+      Packet response = sendReadWordCommand(address);
+      for (uint16_t i = 0; i < count; i++) {
+        Packet packet = sendAndReceivePacket(i + 1 < count ? 0x1D40 : 0x0000);
+        keepFirstError(response, packet);
+        Serial.write((uint8_t)(packet.data >> 8));
+        Serial.write((uint8_t)packet.data);
+      }
+      writePacketToUSB(response);
+      break;
+    }
+    case 'V': { // for Verify
+      // A 32-bit address, a 16-bit count (of at least 1) and a 16-bit pattern
+      // follow. That many words are read as with 'D', but each is compared with
+      // the pattern rather than being returned. Two responses are returned: that
+      // of the READ.W command, then one with the number of words that did not
+      // match (up to 0xFFFF), or the first error encountered while reading.
+      uint32_t address = getNextFourBytesFromUSB();
+      uint16_t count = getNextTwoBytesFromUSB();
+      uint16_t pattern = getNextTwoBytesFromUSB();
+      writePacketToUSB(sendReadWordCommand(address));
+      Packet result = {0, 0};
+      for (uint16_t i = 0; i < count; i++) {
+        Packet packet = sendAndReceivePacket(i + 1 < count ? 0x1D40 : 0x0000);
+        if (isErrorPacket(result)) {
+          continue;
+        }
+        if (isErrorPacket(packet)) {
+          result = packet;
+        } else if (packet.data != pattern && result.data < 0xFFFF) {
+          result.data++;
+        }
+      }
+      writePacketToUSB(result);
+      break;
+    }
+    case 'T':   // for Test memory
+    case 'G': { // for test memory with a Generated pattern
+      // Two 32-bit addresses follow: the start (inclusive) and end (exclusive)
+      // of a range of RAM. Each longword in the range is written with its own
+      // address, then read back, stopping at the first that doesn't match.
+      // With 'G', a pattern byte and a 32-bit value follow the addresses, and
+      // each longword is written with getTestPatternValue instead.
+      // Six responses are returned: that of the first packet sent, or the first
+      // error thereafter (as with 'M'); one whose data is 1 if a longword didn't
+      // match (otherwise 0); then the address of that longword and the value
+      // read from it, as two words each.
+      uint32_t address = getNextFourBytesFromUSB();
+      uint32_t end = getNextFourBytesFromUSB();
+      uint8_t pattern = TEST_PATTERN_ADDRESS;
+      uint32_t patternValue = 0;
+      if (command == 'G') {
+        pattern = getNextByteFromUSB();
+        patternValue = getNextFourBytesFromUSB();
+      }
+      Packet response = {0, 0};
+      uint32_t value = 0;
+      bool isFirstPacket = true;
+      for (; address < end; address += 4) {
+        uint16_t high = address >> 16;
+        uint16_t low = address;
+        uint32_t expected = getTestPatternValue(pattern, patternValue, address);
+        uint16_t packets[8] = {
+            0x1880, high, low, (uint16_t)(expected >> 16), (uint16_t)expected, // WRITE.L
+            0x1980, high, low,                                                 // READ.L it back
+        };
+        for (uint8_t i = 0; i < 8; i++) {
+          Packet packet = sendAndReceivePacket(packets[i]);
+          if (isFirstPacket || (isErrorPacket(packet) && !isErrorPacket(response))) {
+            response = packet;
+          }
+          isFirstPacket = false;
+        }
+        Packet valueHigh = receivePacket();
+        Packet valueLow = receivePacket();
+        if (isErrorPacket(valueHigh) || isErrorPacket(valueLow)) {
+          if (!isErrorPacket(response)) {
+            response = isErrorPacket(valueHigh) ? valueHigh : valueLow;
+          }
+        }
+        value = (((uint32_t)valueHigh.data) << 16) | valueLow.data;
+        if (isErrorPacket(response) || value != expected) {
+          break;
+        }
+      }
+      writePacketToUSB(response);
+      Packet results[5] = {
+          {0, address < end},
+          {0, (uint16_t)(address >> 16)},
+          {0, (uint16_t)address},
+          {0, (uint16_t)(value >> 16)},
+          {0, (uint16_t)value},
+      };
+      for (uint8_t i = 0; i < 5; i++) {
+        writePacketToUSB(results[i]);
+      }
+      break;
+    }
+    case 'X': { // for eXecute one instruction
+      // Resume execution (single-step mode must already be enabled in the CSR),
+      // then read the program counter, D0-D7 and A0-A7. 35 responses are
+      // returned: that of the first packet sent, or the first error thereafter
+      // (as with 'M'), then each value read as two words, high word first.
+      Packet response = sendAndReceivePacket(0x0C00); // GO
+      Packet values[34];
+      for (uint8_t i = 0; i < 17; i++) {
+        if (i == 0) {
+          uint16_t packets[3] = {0x2980, 0x0000, 0x080F}; // RCREG of the PC
+          for (uint8_t j = 0; j < 3; j++) {
+            keepFirstError(response, sendAndReceivePacket(packets[j]));
+          }
+        } else if (i <= 8) {
+          keepFirstError(response, sendAndReceivePacket(0x2180 | (i - 1))); // RDREG
+        } else {
+          keepFirstError(response, sendAndReceivePacket(0x2188 | (i - 9))); // RAREG
+        }
+        values[i * 2] = receivePacket();
+        values[(i * 2) + 1] = receivePacket();
+      }
+      writePacketToUSB(response);
+      for (uint8_t i = 0; i < 34; i++) {
+        writePacketToUSB(values[i]);
+      }
       break;
     }
     }
@@ -1,15 +1,88 @@
+import os
 import time
-import random
-from typing import List, Iterable
-from arduino_coldfire_bdm.serial_interface import ColdfireSerialInterface
+import struct
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, List, Iterable, NamedTuple, Optional, Tuple
+from arduino_coldfire_bdm.control_registers import ControlRegisters
+from arduino_coldfire_bdm.serial_interface import (
+    ColdfireSerialInterface,
+    Response,
+    EXTENSION_CSR_READ_MODIFY_WRITE,
+    EXTENSION_FLASH_WRITE,
+    EXTENSION_FLASH_PROGRAM,
+    EXTENSION_READ_WORDS,
+    EXTENSION_READ_PACKED_WORDS,
+    EXTENSION_VERIFY_WORDS,
+    EXTENSION_TEST_MEMORY,
+    EXTENSION_TEST_MEMORY_PATTERN,
+    EXTENSION_STEP_AND_SNAPSHOT,
+    MAX_FLASH_WRITE_WORDS,
+    MAX_READ_WORDS,
+    MemoryTestPattern,
+)
 
 
 NUM_ADDRESS_REGISTERS = 8
 NUM_DATA_REGISTERS = 8
 
+# BDM command words for each register, precomputed to keep register access fast.
+# (These are dicts rather than tuples so that negative register numbers are rejected.)
+READ_ADDRESS_REGISTER_COMMANDS = {i: 0x2188 | i for i in range(NUM_ADDRESS_REGISTERS)}
+READ_DATA_REGISTER_COMMANDS = {i: 0x2180 | i for i in range(NUM_DATA_REGISTERS)}
+WRITE_ADDRESS_REGISTER_COMMANDS = {i: 0x2088 | i for i in range(NUM_ADDRESS_REGISTERS)}
+WRITE_DATA_REGISTER_COMMANDS = {i: 0x2080 | i for i in range(NUM_DATA_REGISTERS)}
+
+# Precompiled formats for command operands: a 32-bit address (or control register
+# number, or register data), optionally followed by a word or longword of data.
+LONGWORD = struct.Struct(">I")
+ADDRESS_AND_WORD = struct.Struct(">IH")
+ADDRESS_AND_LONGWORD = struct.Struct(">II")
+
+# The operands of the RCREG command that reads each known control register:
+READ_CONTROL_REGISTER_OPERANDS = {
+    register: LONGWORD.pack(register) for register in ControlRegisters
+}
+
+# The number of bytes of operands that follow each BDM command word sent by
+# BDMCommandInterface. The message to send each command is encoded once, up front.
+COMMAND_OPERAND_SIZES = {
+    0x0000: 0,  # NOP
+    0x0C00: 0,  # GO
+    0x1900: LONGWORD.size,  # READ (byte)
+    0x1940: LONGWORD.size,  # READ (word)
+    0x1980: LONGWORD.size,  # READ (longword)
+    0x1800: ADDRESS_AND_WORD.size,  # WRITE (byte)
+    0x1840: ADDRESS_AND_WORD.size,  # WRITE (word)
+    0x1880: ADDRESS_AND_LONGWORD.size,  # WRITE (longword)
+    0x2980: LONGWORD.size,  # RCREG
+    0x2880: ADDRESS_AND_LONGWORD.size,  # WCREG
+    0x2D80: 0,  # RDMREG (CSR)
+    0x2C80: LONGWORD.size,  # WDMREG (CSR)
+    **{command: 0 for command in READ_ADDRESS_REGISTER_COMMANDS.values()},
+    **{command: 0 for command in READ_DATA_REGISTER_COMMANDS.values()},
+    **{command: LONGWORD.size for command in WRITE_ADDRESS_REGISTER_COMMANDS.values()},
+    **{command: LONGWORD.size for command in WRITE_DATA_REGISTER_COMMANDS.values()},
+}
+
+# The number of words read at a time by `dump_words`:
+DUMP_CHUNK_SIZE_WORDS = 4096
+
+# The number of words to read per message from Arduinos that can read memory themselves
+# (see EXTENSION_READ_WORDS and EXTENSION_READ_PACKED_WORDS). Each message is sent before
+# reading the previous one's responses, so this is small enough to keep a second message
+# in flight most of the time.
+READ_WORDS_MESSAGE_SIZE = 256
+
+# The number of bytes of memory tested at a time by `test_memory`:
+MEMORY_TEST_CHUNK_SIZE = 0x1000
+
 
 def format_hex_list(values: List[int]) -> str:
-    return f"[{', '.join([f'0x{v:08x}' for v in values])}]"
+    # Format all of the values at once, then split into 8-digit (32-bit) chunks:
+    digits = struct.pack(f">{len(values)}I", *values).hex()
+    return f"[{', '.join(['0x' + digits[i : i + 8] for i in range(0, len(digits), 8)])}]"
 
 
 class ConfigurationStatusRegister:
@@ -24,6 +97,20 @@ class ConfigurationStatusRegister:
         return bool((self.data >> 4) & 0x1)
 
 
+class RegisterSnapshot(NamedTuple):
+    """
+    The contents of the program counter and general-purpose registers of a halted processor.
+    """
+
+    pc: int
+    data_registers: Tuple[int, ...]
+    address_registers: Tuple[int, ...]
+
+    @property
+    def sp(self) -> int:
+        return self.address_registers[7]
+
+
 class BDMCommandInterface:
     """
     A wrapper around a ColdfireSerialInterface that provides
@@ -32,36 +119,234 @@ class BDMCommandInterface:
 
     def __init__(self, interface: ColdfireSerialInterface):
         self.interface = interface
+        # Bind the interface methods used for every command once, rather than looking
+        # them up on every call; these are called millions of times when loading Flash.
+        self._send_frame_deferred = interface.send_frame_deferred
+        self._receive_packet_deferred = interface.receive_packet_deferred
+        self._read_deferred_response = interface.read_deferred_response
+        self._frames = {
+            command: interface.frame(command, operand_size)
+            for command, operand_size in COMMAND_OPERAND_SIZES.items()
+        }
         self.current_step_mode = False
+        self.in_unlock_bypass_mode = False
+        # The last value read from or written to the debug CSR, if any:
+        self._cached_csr = None
+        # If not None, a list of (response_size_words, future) tuples for commands
+        # sent in pipelined mode whose responses have not been read yet.
+        self._pipelined = None
+        # Commands sent by `_send` whose acknowledgements have not been read yet; see `flush`.
+        self._pending_acks = deque()
+        # State for `enable_read_prefetch`:
+        self._prefetch_size_words = 0
+        self._prefetched_words = {}
+        self._next_sequential_read_address = None
+        self._num_sequential_reads = 0
 
-    def _send(self, *commands):
+    def enable_read_prefetch(self, num_words: int = 16):
         """
-        Send one or more 16-bit packets (`commands`) while receiving (and discarding) any
-        responses from previously-sent commands. This method will still throw exceptions
-        if any of the previous commands failed.
+        Detect sequential calls to `read_word` and `read_longword` (i.e.: reading
+        each address in turn, as in a loop) and once detected, read ahead by
+        `num_words` words with a single dump, serving later reads from that data.
+        Any write or execution of instructions discards all prefetched data.
+
+        This is disabled by default, as reading ahead is not safe when reading from
+        memory-mapped peripherals, for which reads may have side effects. Reading ahead
+        may also run into unmapped memory, causing a bus error; if so, the read that
+        triggered it is sent directly instead. Pass 0 to disable prefetching again.
+        """
+        self._prefetch_size_words = num_words
+        self._prefetched_words.clear()
+
+    def _read_prefetched(self, address: int, num_words: int) -> Optional[int]:
+        """
+        Return the value of `num_words` words at `address` from prefetched data if possible,
+        prefetching more data if this read continues a sequence. Returns None otherwise.
         """
-        for command in commands:
-            self.interface.send_and_receive_packet(command)
+        if address % 2 or self._pipelined is not None:
+            return None
+        if address == self._next_sequential_read_address:
+            self._num_sequential_reads += 1
+        else:
+            self._num_sequential_reads = 0
+        self._next_sequential_read_address = address + (num_words * 2)
+
+        addresses = range(address, address + (num_words * 2), 2)
+        if any(a not in self._prefetched_words for a in addresses):
+            # Only start reading ahead after seeing a few sequential reads in a row:
+            if self._num_sequential_reads < 2:
+                return None
+            num_words_to_read = max(self._prefetch_size_words, num_words)
+            try:
+                data = self.dump_words_bulk(address, num_words_to_read)
+            except ValueError:
+                # Reading ahead may have reached unmapped memory; read this directly instead:
+                self._prefetched_words.clear()
+                self._num_sequential_reads = 0
+                return None
+            self._prefetched_words = dict(
+                zip(
+                    range(address, address + (num_words_to_read * 2), 2),
+                    struct.unpack(f">{num_words_to_read}H", data),
+                )
+            )
+
+        value = 0
+        for a in addresses:
+            value = (value << 16) | self._prefetched_words[a]
+        return value
+
+    def _read_deferred_responses(self, count: int) -> List[Response]:
+        # Read every response before raising any errors, to keep the serial stream in sync:
+        responses = []
+        error = None
+        for _ in range(count):
+            try:
+                responses.append(self._read_deferred_response())
+            except ValueError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return responses
 
-    def _send_then_receive(self, *commands, response_size_words: int = 1) -> int:
+    def flush(self):
         """
-        Send one or more 16-bit packets (`commands`) then receive `response_size_words` words.
-        Returns a single integer, which is the response data.
+        Wait for the Coldfire to acknowledge every command sent without waiting for a
+        response (i.e.: all writes) so far. Errors from those commands are raised here,
+        rather than when the commands were sent. This is called automatically before
+        any command that returns data.
+        """
+        self._wait_for_acks(0)
+
+    def _wait_for_acks(self, max_pending: int):
+        """
+        Like `flush`, but only wait until at most `max_pending` commands remain
+        unacknowledged, leaving the rest in flight.
+        """
+        error = None
+        while len(self._pending_acks) > max_pending:
+            command = self._pending_acks.popleft()
+            try:
+                self._read_deferred_response()
+            except ValueError as e:
+                error = error or ValueError(f"While sending command 0x{command:04x}: {e}")
+        if error is not None:
+            raise error
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Send all commands issued within this context back-to-back, without waiting
+        for any responses until the context exits. This turns N round-trips to the
+        Arduino into roughly one. Methods that would normally return response data
+        instead return a `concurrent.futures.Future` of that data, which is resolved
+        once the context exits:
+
+            with bdm.pipeline():
+                futures = [bdm.read_data_register(i) for i in range(8)]
+            values = [future.result() for future in futures]
+
+        If any command fails, the first failure is raised when the context exits.
         """
-        for command in commands:
-            self.interface.send_and_receive_packet(command)
-        responses = [self.interface.receive_packet() for _ in range(response_size_words)]
+        if self._pipelined is not None:
+            # Already pipelining; the outermost context will read the responses.
+            yield
+            return
+
+        self.flush()
+        self._pipelined = []
+        error = None
+        try:
+            yield
+        finally:
+            pending, self._pipelined = self._pipelined, None
+            # Always read every outstanding response, even if a command failed,
+            # to keep the serial stream in sync:
+            for response_size_words, future in pending:
+                try:
+                    responses = self._read_deferred_responses(1 + response_size_words)
+                except ValueError as e:
+                    future.set_exception(e)
+                    error = error or e
+                    continue
+                future.set_result(self._combine_responses(responses[1:]))
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _combine_responses(responses) -> Optional[int]:
+        if not responses:
+            return None
         response_data = responses[0].data
         if len(responses) == 2:
             response_data <<= 16
             response_data |= responses[1].data
         return response_data
 
+    def _send_pipelined(self, command: int, operands: bytes, response_size_words: int) -> Future:
+        self._send_frame_deferred(self._frames[command], operands)
+        for _ in range(response_size_words):
+            self._receive_packet_deferred()
+        future = Future()
+        self._pipelined.append((response_size_words, future))
+        return future
+
+    def _send(self, command: int, operands: bytes = b""):
+        """
+        Send a BDM command word (followed by `operands` as big-endian bytes) without
+        waiting for any responses. The responses will be read (and discarded) by the
+        next call to `flush`, which will still throw exceptions if any of the commands
+        failed.
+        """
+        if self._prefetched_words:
+            self._prefetched_words.clear()
+        if self._pipelined is not None:
+            return self._send_pipelined(command, operands, 0)
+        self._send_frame_deferred(self._frames[command], operands)
+        self._pending_acks.append(command)
+
+    def _expect_ack(self, command: int):
+        """
+        Track the response to a command sent directly through the interface (rather
+        than by `_send`), so that it is read (and checked for errors) like any other.
+        """
+        if self._pipelined is not None:
+            self._pipelined.append((0, Future()))
+        else:
+            self._pending_acks.append(command)
+
+    def _send_then_receive_word(self, command: int, operands: bytes = b"") -> int:
+        """
+        Send a BDM command word (followed by `operands` as big-endian bytes) then
+        receive and return a single word in response.
+        """
+        if self._pipelined is not None:
+            return self._send_pipelined(command, operands, 1)
+        self.flush()
+        self._send_frame_deferred(self._frames[command], operands)
+        self._receive_packet_deferred()
+        _, response = self._read_deferred_responses(2)
+        return response.data
+
+    def _send_then_receive_longword(self, command: int, operands: bytes = b"") -> int:
+        """
+        Send a BDM command word (followed by `operands` as big-endian bytes) then
+        receive and return a longword (two words) in response.
+        """
+        if self._pipelined is not None:
+            return self._send_pipelined(command, operands, 2)
+        self.flush()
+        self._send_frame_deferred(self._frames[command], operands)
+        self._receive_packet_deferred()
+        self._receive_packet_deferred()
+        _, high, low = self._read_deferred_responses(3)
+        return (high.data << 16) | low.data
+
     def noop(self):
         """
         Perform no operation; may be used as a null command.
         """
-        return self._send_then_receive(0x0000)
+        return self._send_then_receive_word(0x0000)
 
     def go(self):
         """
@@ -70,7 +355,8 @@ class BDMCommandInterface:
         this is the equivalent of GDB/LLDB's "continue" command.
         """
         self.set_single_step_mode(False)
-        return self._send_then_receive(0x0C00)
+        self._prefetched_words.clear()
+        return self._send_then_receive_word(0x0C00)
 
     def step(self):
         """
@@ -79,58 +365,111 @@ class BDMCommandInterface:
         equivalent of GDB/LLDB's "step" command.
         """
         self.set_single_step_mode(True)
-        return self._send_then_receive(0x0C00)
+        self._prefetched_words.clear()
+        return self._send_then_receive_word(0x0C00)
+
+    def read_registers(self) -> RegisterSnapshot:
+        """
+        Read the program counter and all of the address and data registers at once.
+        """
+        with self.pipeline():
+            pc = self.read_control_register(ControlRegisters.PC)
+            data_futures = [self.read_data_register(i) for i in range(NUM_DATA_REGISTERS)]
+            address_futures = [self.read_address_register(i) for i in range(NUM_ADDRESS_REGISTERS)]
+        return RegisterSnapshot(
+            pc.result(),
+            tuple([f.result() for f in data_futures]),
+            tuple([f.result() for f in address_futures]),
+        )
+
+    def step_and_snapshot(self) -> RegisterSnapshot:
+        """
+        Execute the next instruction (as with `step`), then read the program counter and
+        all of the address and data registers (as with `read_registers`). If the Arduino
+        sketch supports it, this takes a single round-trip to the Arduino.
+        """
+        if EXTENSION_STEP_AND_SNAPSHOT not in self.interface.extensions:
+            self.step()
+            return self.read_registers()
+
+        self.set_single_step_mode(True)
+        self._prefetched_words.clear()
+        self.flush()
+        self.interface.step_and_snapshot_deferred()
+        self._read_deferred_response()
+        num_longwords = 1 + NUM_DATA_REGISTERS + NUM_ADDRESS_REGISTERS
+        buffer = bytearray(num_longwords * 4)
+        self.interface.read_deferred_responses_into(buffer, num_longwords * 2)
+        values = struct.unpack(f">{num_longwords}I", buffer)
+        return RegisterSnapshot(
+            values[0],
+            values[1 : 1 + NUM_DATA_REGISTERS],
+            values[1 + NUM_DATA_REGISTERS :],
+        )
 
     def read_byte(self, address: int) -> int:
         """
         Read a single byte from the provided memory address.
         """
-        return self._send_then_receive(0x1900, address >> 16, address & 0xFFFF) & 0xFF
+        return self._send_then_receive_word(0x1900, LONGWORD.pack(address)) & 0xFF
 
     def read_word(self, address: int) -> int:
         """
         Read a single word (16 bits) from the provided memory address.
         """
-        return self._send_then_receive(0x1940, address >> 16, address & 0xFFFF)
+        if self._prefetch_size_words:
+            value = self._read_prefetched(address, 1)
+            if value is not None:
+                return value
+        return self._send_then_receive_word(0x1940, LONGWORD.pack(address))
 
     def read_longword(self, address: int) -> int:
         """
         Read a longword (32 bits) from the provided memory address.
         """
-        return self._send_then_receive(
-            0x1980, address >> 16, address & 0xFFFF, response_size_words=2
-        )
+        if self._prefetch_size_words:
+            value = self._read_prefetched(address, 2)
+            if value is not None:
+                return value
+        return self._send_then_receive_longword(0x1980, LONGWORD.pack(address))
 
     def read_address_register(self, register_number: int) -> int:
         """
         Read the 32-bit contents of the given address register.
         """
-        if register_number > (NUM_ADDRESS_REGISTERS - 1) or register_number < 0:
+        try:
+            command = READ_ADDRESS_REGISTER_COMMANDS[register_number]
+        except KeyError:
             raise ValueError(
                 f"Can't read register {register_number:,} - Coldfire only has"
                 f" {NUM_ADDRESS_REGISTERS} address registers!"
-            )
-        return self._send_then_receive(0x2188 | register_number, response_size_words=2)
+            ) from None
+        return self._send_then_receive_longword(command)
 
     def read_data_register(self, register_number) -> int:
         """
         Read the 32-bit contents of the given data register.
         """
-        if register_number > (NUM_DATA_REGISTERS - 1) or register_number < 0:
+        try:
+            command = READ_DATA_REGISTER_COMMANDS[register_number]
+        except KeyError:
             raise ValueError(
                 f"Can't read register {register_number:,} - Coldfire only has"
                 f" {NUM_DATA_REGISTERS} data registers!"
-            )
-        return self._send_then_receive(0x2180 | register_number, response_size_words=2)
+            ) from None
+        return self._send_then_receive_longword(command)
 
     def read_control_register(self, register_encoding: int) -> int:
         """
         Read the contents of one of the system control registers.
         See the Coldfire manual for these control registers.
         """
-        if register_encoding < 0 or register_encoding > 4095:
-            raise ValueError("Coldfire only has a 12-bit control register field!")
-        return self._send_then_receive(0x2980, 0, register_encoding & 0xFFF, response_size_words=2)
+        operands = READ_CONTROL_REGISTER_OPERANDS.get(register_encoding)
+        if operands is None:
+            if register_encoding < 0 or register_encoding > 4095:
+                raise ValueError("Coldfire only has a 12-bit control register field!")
+            operands = LONGWORD.pack(register_encoding & 0xFFF)
+        return self._send_then_receive_longword(0x2980, operands)
 
     def read_debug_configuration_status_register(self) -> ConfigurationStatusRegister:
         """
@@ -138,7 +477,9 @@ class BDMCommandInterface:
         This register stores data including (but not limited to) the processor step mode,
         useful for stepping through instruction-by-instruction.
         """
-        return ConfigurationStatusRegister(self._send_then_receive(0x2D80, response_size_words=2))
+        csr = ConfigurationStatusRegister(self._send_then_receive_longword(0x2D80))
+        self._cached_csr = csr.data
+        return csr
 
     def write_debug_configuration_status_register(self, new_value: int):
         """
@@ -146,7 +487,8 @@ class BDMCommandInterface:
         This register stores data including (but not limited to) the processor step mode,
         useful for stepping through instruction-by-instruction.
         """
-        return self._send_then_receive(0x2C80, new_value >> 16, new_value & 0xFFF)
+        self._cached_csr = new_value
+        return self._send_then_receive_word(0x2C80, LONGWORD.pack(new_value))
 
     def set_single_step_mode(self, enabled=True):
         """
@@ -156,27 +498,290 @@ class BDMCommandInterface:
         """
         if self.current_step_mode == enabled:
             return
-        csr = self.read_debug_configuration_status_register()
-        new_register = csr.data
-        new_register &= 0xFFFFFFEF
-        if enabled:
-            new_register |= 0b10000
-        self.write_debug_configuration_status_register(new_register)
+        and_mask = 0xFFFFFFEF
+        or_mask = 0b10000 if enabled else 0
+        if EXTENSION_CSR_READ_MODIFY_WRITE in self.interface.extensions:
+            # Let the Arduino read and write back the CSR itself, avoiding a round-trip:
+            self.interface.read_modify_write_csr_deferred(and_mask, or_mask)
+            self._expect_ack(0x2C80)
+            if self._cached_csr is not None:
+                self._cached_csr = (self._cached_csr & and_mask) | or_mask
+        else:
+            # Only read the CSR if we don't already know its contents:
+            if self._cached_csr is None:
+                self.read_debug_configuration_status_register()
+            self.write_debug_configuration_status_register((self._cached_csr & and_mask) | or_mask)
         self.current_step_mode = enabled
 
-    def dump_words(self, base_address: int, num_words: int) -> Iterable[int]:
+    def _dump_bulk(
+        self,
+        read_command: int,
+        dump_command: int,
+        base_address: int,
+        num_words: int,
+        words_per_item: int,
+        window: int,
+    ) -> bytes:
+        """
+        Read `num_words` 16-bit words from memory, starting at `base_address`, by sending
+        `read_command` once and then `dump_command` repeatedly. The data is returned as
+        big-endian bytes. Up to `window` words are requested ahead of those being read.
+        """
+        buffer = bytearray(num_words * 2)
+        if not num_words:
+            return bytes(buffer)
+        self.flush()
+
+        self.interface.send_packets([read_command, base_address >> 16, base_address & 0xFFFF])
+
+        def request_words(start: int, stop: int):
+            # Each DUMP is sent while receiving the last word of the previous item, so
+            # the final word (and every other word of each item) is requested with a no-op.
+            packets = []
+            for index in range(start, stop):
+                is_last_word_of_item = index % words_per_item == words_per_item - 1
+                if is_last_word_of_item and index < num_words - 1:
+                    packets.append(dump_command)
+                else:
+                    packets.append(0x0000)
+            self.interface.send_and_receive_packets_deferred(packets)
+
+        # Read half of the window at a time, so that the other half stays in flight:
+        chunk_size = max(window // 2, 1)
+        num_requested = 0
+        num_received = 0
+        try:
+            while num_received < num_words:
+                stop = min(num_words, num_received + max(window, 1))
+                if stop > num_requested:
+                    request_words(num_requested, stop)
+                    num_requested = stop
+                count = min(chunk_size, num_requested - num_received)
+                # (These responses are read even if this raises an exception.)
+                num_received += count
+                self.interface.read_deferred_responses_into(
+                    buffer, count, (num_received - count) * 2
+                )
+        finally:
+            # If reading failed, keep the serial stream in sync for later commands:
+            num_outstanding = num_requested - num_received
+            if num_requested < num_words and num_requested % words_per_item == 0:
+                # A DUMP was sent for the next item; shift out all but the last word of its
+                # result (which, as usual, is shifted out by the next command):
+                self.interface.send_and_receive_packets_deferred([0x0000] * (words_per_item - 1))
+                num_outstanding += words_per_item - 1
+            self.interface.discard_deferred_responses(num_outstanding)
+        return bytes(buffer)
+
+    def dump_words_bulk(self, base_address: int, num_words: int, window: int = 16) -> bytes:
+        """
+        Dump successive 16-bit words from the provided base address, returning them
+        as big-endian bytes. This is the fastest way to read a block of memory; the
+        address of each word does not need to be specified, and up to `window` words
+        are requested ahead of those being read, keeping the serial link busy in both
+        directions rather than waiting for a full round-trip per word.
+        """
+        if (
+            EXTENSION_READ_WORDS in self.interface.extensions
+            or EXTENSION_READ_PACKED_WORDS in self.interface.extensions
+        ):
+            return self._read_words_on_arduino(base_address, num_words)
+        return self._dump_bulk(0x1940, 0x1D40, base_address, num_words, 1, window)
+
+    def _read_words_on_arduino(self, base_address: int, num_words: int) -> bytes:
+        """
+        Like `_dump_bulk`, but having the Arduino send the READ and DUMP commands itself,
+        in messages of up to `READ_WORDS_MESSAGE_SIZE` words. Each message is sent before
+        reading the responses to the last, so that the Arduino never waits for the host.
+        """
+        buffer = bytearray(num_words * 2)
+        self.flush()
+        # If possible, have the Arduino send only the words, rather than a response per word:
+        packed = EXTENSION_READ_PACKED_WORDS in self.interface.extensions
+
+        # The number of responses (deferred commands) that have been requested but not read:
+        num_outstanding = 0
+
+        def request_words(offset: int) -> int:
+            nonlocal num_outstanding
+            count = min(READ_WORDS_MESSAGE_SIZE, num_words - offset)
+            if packed:
+                self.interface.read_packed_words_deferred(base_address + (offset * 2), count)
+                num_outstanding += 1
+            else:
+                self.interface.read_words_deferred(base_address + (offset * 2), count)
+                num_outstanding += 1 + count
+            return count
+
+        counts = deque()
+        try:
+            if num_words:
+                counts.append(request_words(0))
+            for offset in range(0, num_words, READ_WORDS_MESSAGE_SIZE):
+                next_offset = offset + READ_WORDS_MESSAGE_SIZE
+                if next_offset < num_words:
+                    counts.append(request_words(next_offset))
+                count = counts.popleft()
+                # (Each of these reads its responses even if it raises an exception.)
+                if packed:
+                    num_outstanding -= 1
+                    self.interface.read_deferred_words_into(buffer, count, offset * 2)
+                else:
+                    # The first response to each message is that of the READ command itself:
+                    num_outstanding -= 1
+                    self._read_deferred_response()
+                    num_outstanding -= count
+                    self.interface.read_deferred_responses_into(buffer, count, offset * 2)
+        finally:
+            # If reading failed, keep the serial stream in sync for later commands:
+            self.interface.discard_deferred_responses(num_outstanding)
+        return bytes(buffer)
+
+    def dump_longwords(self, base_address: int, num_longwords: int, window: int = 16) -> bytes:
+        """
+        Dump successive 32-bit longwords from the provided base address, returning them
+        as big-endian bytes. This sends half as many commands as `dump_words_bulk`.
+        """
+        return self._dump_bulk(0x1980, 0x1D80, base_address, num_longwords * 2, 2, window)
+
+    def read_memory_block(self, address: int, num_bytes: int) -> bytes:
+        """
+        Read `num_bytes` bytes of memory starting at `address`, using the widest
+        transfers possible given the alignment of the requested range.
+        """
+        result = bytearray()
+        end = address + num_bytes
+        if address % 2 and address < end:
+            result.append(self.read_byte(address))
+            address += 1
+        if address % 4 and address + 2 <= end:
+            result += self.read_word(address).to_bytes(2, "big")
+            address += 2
+        num_longwords = (end - address) // 4
+        if num_longwords:
+            result += self.dump_longwords(address, num_longwords)
+            address += num_longwords * 4
+        if address + 2 <= end:
+            result += self.read_word(address).to_bytes(2, "big")
+            address += 2
+        if address < end:
+            result.append(self.read_byte(address))
+        return bytes(result)
+
+    def verify_pattern(self, base_address: int, num_words: int, pattern: int = 0xFFFF) -> bool:
+        """
+        Return True if each of the `num_words` 16-bit words of memory starting at
+        `base_address` is equal to `pattern` (by default, checking that Flash memory
+        has been erased). If the Arduino sketch supports it, the words are compared
+        by the Arduino rather than being sent to the host, making this much faster.
+        """
+        if EXTENSION_VERIFY_WORDS not in self.interface.extensions:
+            expected = struct.pack(">H", pattern) * num_words
+            return self.dump_words_bulk(base_address, num_words) == expected
+
+        self.flush()
+        for offset in range(0, num_words, MAX_READ_WORDS):
+            count = min(MAX_READ_WORDS, num_words - offset)
+            self.interface.verify_words_deferred(base_address + (offset * 2), count, pattern)
+            _, num_mismatches = self._read_deferred_responses(2)
+            if num_mismatches.data:
+                return False
+        return True
+
+    def test_memory(
+        self,
+        start_address: int,
+        end_address: int,
+        pattern: MemoryTestPattern = MemoryTestPattern.ADDRESS,
+        pattern_value: int = 0,
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Test the RAM from `start_address` up to `end_address` by writing a value to each
+        longword (by default, its own address; see `MemoryTestPattern`), then reading it
+        back. Returns the address and value read of the first longword that didn't match,
+        or None if all of them matched. If the Arduino sketch supports it, the Arduino
+        does this itself, without waiting for a round-trip to the host per longword.
+        """
+        if EXTENSION_TEST_MEMORY_PATTERN in self.interface.extensions or (
+            pattern == MemoryTestPattern.ADDRESS
+            and EXTENSION_TEST_MEMORY in self.interface.extensions
+        ):
+            return self._test_memory_on_arduino(start_address, end_address, pattern, pattern_value)
+
+        for chunk_start in range(start_address, end_address, MEMORY_TEST_CHUNK_SIZE):
+            # Send all of the writes for this chunk back-to-back, then read them all back:
+            chunk_end = min(end_address, chunk_start + MEMORY_TEST_CHUNK_SIZE)
+            addresses = range(chunk_start, chunk_end, 4)
+            expected_values = [pattern.expected_value(a, pattern_value) for a in addresses]
+            for address, expected in zip(addresses, expected_values):
+                self.write_longword(address, expected)
+            values = struct.unpack(
+                f">{len(addresses)}I", self.dump_longwords(chunk_start, len(addresses))
+            )
+            for address, expected, value in zip(addresses, expected_values, values):
+                if value != expected:
+                    return address, value
+        return None
+
+    def _test_memory_on_arduino(
+        self,
+        start_address: int,
+        end_address: int,
+        pattern: MemoryTestPattern,
+        pattern_value: int,
+    ) -> Optional[Tuple[int, int]]:
+        # Test a chunk at a time, sending each chunk before reading the results of the last:
+        self.flush()
+        # The memory being tested is overwritten, so any prefetched words are now stale:
+        if self._prefetched_words:
+            self._prefetched_words.clear()
+        chunk_starts = range(start_address, end_address, MEMORY_TEST_CHUNK_SIZE)
+        # The number of responses that have been requested but not read:
+        num_outstanding = 0
+
+        def request_test(chunk_start: int):
+            nonlocal num_outstanding
+            chunk_end = min(end_address, chunk_start + MEMORY_TEST_CHUNK_SIZE)
+            if pattern == MemoryTestPattern.ADDRESS:
+                self.interface.test_memory_deferred(chunk_start, chunk_end)
+            else:
+                self.interface.test_memory_pattern_deferred(
+                    chunk_start, chunk_end, pattern, pattern_value
+                )
+            num_outstanding += 6
+
+        try:
+            if chunk_starts:
+                request_test(chunk_starts[0])
+            for i in range(len(chunk_starts)):
+                if i + 1 < len(chunk_starts):
+                    request_test(chunk_starts[i + 1])
+                # (These responses are read even if this raises an exception.)
+                num_outstanding -= 6
+                _, failed, address_high, address_low, value_high, value_low = (
+                    self._read_deferred_responses(6)
+                )
+                if failed.data:
+                    address = (address_high.data << 16) | address_low.data
+                    return address, (value_high.data << 16) | value_low.data
+        finally:
+            # Keep the serial stream in sync if we stopped before reading every chunk's results:
+            self.interface.discard_deferred_responses(num_outstanding)
+        return None
+
+    def dump_words(self, base_address: int, num_words: int, window: int = 16) -> Iterable[int]:
         """
         Dump successive 16-bit words from the provided base address in an efficient manner.
         This is about three times faster than reading individual words, as the address of
         each word does not need to be specified.
+
+        Words are read in chunks with `dump_words_bulk`; use that method directly to avoid
+        the overhead of returning each word individually.
         """
-        self.interface.send_packet(0x1940)
-        self.interface.send_packet(base_address >> 16)
-        self.interface.send_packet(base_address & 0xFFFF)
-        num_words -= 1
-        for _ in range(num_words):
-            yield self.interface.send_and_receive_packet(0x1D40).data
-        yield self.interface.receive_packet().data
+        for chunk_start in range(0, num_words, DUMP_CHUNK_SIZE_WORDS):
+            chunk_size = min(DUMP_CHUNK_SIZE_WORDS, num_words - chunk_start)
+            chunk = self.dump_words_bulk(base_address + (chunk_start * 2), chunk_size, window)
+            yield from struct.unpack(f">{chunk_size}H", chunk)
 
     def write_byte(self, address: int, data: int):
         """
@@ -184,7 +789,7 @@ class BDMCommandInterface:
         """
         if data > 255 or data < 0:
             raise ValueError("Cannot write byte out of range for byte!")
-        return self._send(0x1800, address >> 16, address & 0xFFFF, data & 0xFF)
+        return self._send(0x1800, operands=ADDRESS_AND_WORD.pack(address, data))
 
     def write_word(self, address: int, data: int):
         """
@@ -192,41 +797,45 @@ class BDMCommandInterface:
         """
         if data > 0xFFFF or data < 0:
             raise ValueError("Cannot write byte out of range for word!")
-        return self._send(0x1840, address >> 16, address & 0xFFFF, data)
+        return self._send(0x1840, operands=ADDRESS_AND_WORD.pack(address, data))
 
     def write_longword(self, address: int, data: int):
         """
         Write the provided 32-bit longword to the provided address in memory.
         """
-        return self._send(0x1880, address >> 16, address & 0xFFFF, data >> 16, data & 0xFFFF)
+        return self._send(0x1880, operands=ADDRESS_AND_LONGWORD.pack(address, data))
 
     def write_control_register(self, register: int, data: int):
         """
         Write the provided 32-bit longword to the provided control register.
         """
-        return self._send(0x2880, 0, register & 0xFFFF, data >> 16, data & 0xFFFF)
+        return self._send(0x2880, operands=ADDRESS_AND_LONGWORD.pack(register & 0xFFFF, data))
 
     def write_address_register(self, register_number: int, data: int):
         """
         Write the provided 32-bit longword to the provided address register.
         """
-        if register_number > (NUM_ADDRESS_REGISTERS - 1) or register_number < 0:
+        try:
+            command = WRITE_ADDRESS_REGISTER_COMMANDS[register_number]
+        except KeyError:
             raise ValueError(
                 f"Can't write register {register_number:,} - Coldfire only has"
                 f" {NUM_ADDRESS_REGISTERS} address registers!"
-            )
-        return self._send_then_receive(0x2088 | register_number)
+            ) from None
+        return self._send(command, operands=LONGWORD.pack(data))
 
     def write_data_register(self, register_number: int, data: int):
         """
         Write the provided 32-bit longword to the provided data register.
         """
-        if register_number > (NUM_DATA_REGISTERS - 1) or register_number < 0:
+        try:
+            command = WRITE_DATA_REGISTER_COMMANDS[register_number]
+        except KeyError:
             raise ValueError(
                 f"Can't write register {register_number:,} - Coldfire only has"
                 f" {NUM_DATA_REGISTERS} data registers!"
-            )
-        return self._send_then_receive(0x2080 | register_number)
+            ) from None
+        return self._send(command, operands=LONGWORD.pack(data))
 
     def send_flash_write_enable(self):
         """
@@ -274,15 +883,121 @@ class BDMCommandInterface:
         self.write_word(0x00, 0xA0)
         self.write_word(address, data)
 
+    def _send_unlock_bypassed_flash_write_words(self, address: int, data: bytes):
+        # Requires EXTENSION_FLASH_WRITE, and at most MAX_FLASH_WRITE_WORDS words.
+        if self._prefetched_words:
+            self._prefetched_words.clear()
+        if EXTENSION_FLASH_PROGRAM in self.interface.extensions:
+            # Have the Arduino check that each word was programmed successfully, too:
+            self.interface.program_flash_words_deferred(address, data)
+        else:
+            self.interface.write_flash_words_deferred(address, data)
+        self._expect_ack(0x1840)
+
+    def send_unlock_bypassed_flash_write_batch(self, pairs: Iterable[Tuple[int, int]]):
+        """
+        Like `send_unlock_bypassed_flash_write`, but writing each of the provided
+        (address, data) pairs. If the Arduino sketch supports it, runs of consecutive
+        addresses are written by the Arduino itself, requiring far less communication.
+        """
+        if not self.in_unlock_bypass_mode:
+            raise RuntimeError(
+                "To use this method, ensure that `enter_flash_unlock_bypass` has been called first."
+            )
+        if EXTENSION_FLASH_WRITE not in self.interface.extensions:
+            for address, data in pairs:
+                self.send_unlock_bypassed_flash_write(address, data)
+            return
+
+        run_address = 0
+        run = []
+        for address, data in pairs:
+            is_consecutive = address == run_address + (len(run) * 2)
+            if run and (not is_consecutive or len(run) == MAX_FLASH_WRITE_WORDS):
+                self._send_unlock_bypassed_flash_write_words(
+                    run_address, struct.pack(f">{len(run)}H", *run)
+                )
+                run = []
+            if not run:
+                run_address = address
+            run.append(data)
+        if run:
+            self._send_unlock_bypassed_flash_write_words(
+                run_address, struct.pack(f">{len(run)}H", *run)
+            )
+
+    def flash_write_bulk(
+        self,
+        base_address: int,
+        data: bytes,
+        window: int = 64,
+        on_progress: Optional[Callable[[int], None]] = None,
+    ):
+        """
+        If the attached system has a Flash boot ROM mapped at 0x00000000,
+        and `enter_flash_unlock_bypass` has been called, this command writes
+        `data` (an even number of bytes) to the Flash, starting at `base_address`.
+
+        Writes are sent without waiting for their acknowledgements, with up to
+        `window` words in flight at once. If provided, `on_progress` is called
+        with the number of bytes newly acknowledged as the writes complete, about
+        once per `window` words (i.e.: it can be `tqdm.update`).
+        """
+        if not self.in_unlock_bypass_mode:
+            raise RuntimeError(
+                "To use this method, ensure that `enter_flash_unlock_bypass` has been called first."
+            )
+        if len(data) % 2:
+            raise ValueError(f"Expected an even number of bytes to write, but got {len(data):,}.")
+
+        if EXTENSION_FLASH_WRITE in self.interface.extensions:
+            words_per_chunk, acks_per_chunk = MAX_FLASH_WRITE_WORDS, 1
+        else:
+            # Each word written to Flash takes two write commands:
+            words_per_chunk, acks_per_chunk = 1, 2
+        bytes_per_chunk = words_per_chunk * 2
+        max_pending_chunks = max(1, window // words_per_chunk)
+        max_pending = max_pending_chunks * acks_per_chunk
+
+        # Start with no other commands pending, so that each pending ack is one of ours:
+        self.flush()
+        acknowledged = 0
+        # Unpack every word up front (in C) rather than shifting bytes together per word:
+        words = struct.iter_unpack(">H", data) if acks_per_chunk == 2 else None
+        for offset in range(0, len(data), bytes_per_chunk):
+            if acks_per_chunk == 1:
+                self._send_unlock_bypassed_flash_write_words(
+                    base_address + offset, data[offset : offset + bytes_per_chunk]
+                )
+            else:
+                (word,) = next(words)
+                self.write_word(0x00, 0xA0)
+                self.write_word(base_address + offset, word)
+            if len(self._pending_acks) > max_pending:
+                self._wait_for_acks(max_pending)
+                if on_progress is not None:
+                    # Every chunk but the last `max_pending_chunks` has been acknowledged;
+                    # report progress once per window's worth of chunks, rather than per chunk:
+                    written = offset - ((max_pending_chunks - 1) * bytes_per_chunk)
+                    if written - acknowledged >= max_pending_chunks * bytes_per_chunk:
+                        on_progress(written - acknowledged)
+                        acknowledged = written
+        self.flush()
+        if on_progress is not None:
+            on_progress(len(data) - acknowledged)
+
     def exit_flash_unlock_bypass(self):
         """
         If the attached system has a Flash boot ROM mapped at 0x00000000,
         this command tells that Flash chip to exit "unlock bypass mode,"
-        returning to normal operation (that is: disallowing writes).
+        returning to normal operation (that is: disallowing writes). This waits for the
+        writes to be acknowledged rather than deferring them, as this is often called while
+        cleaning up after an error, after which nothing else may be sent.
         """
         self.write_word(0x00, 0x90)
         self.write_word(0x00, 0x00)
         self.in_unlock_bypass_mode = False
+        self.flush()
 
     def send_flash_chip_erase(self):
         """
@@ -295,10 +1010,26 @@ class BDMCommandInterface:
         self.write_word(0x555 << 1, 0xAA)
         self.write_word(0x2AA << 1, 0x55)
         self.write_word(0x555 << 1, 0x10)
+        self.flush()
         # TODO: Read words from the attached Flash to figure out how long to wait for.
         time.sleep(30)
         self.write_word(0x555 << 1, 0xF0)
 
+    def _read_address_and_data_registers(self) -> Tuple[List[int], List[int]]:
+        with self.pipeline():
+            address_futures = [self.read_address_register(i) for i in range(NUM_ADDRESS_REGISTERS)]
+            data_futures = [self.read_data_register(i) for i in range(NUM_DATA_REGISTERS)]
+        return [f.result() for f in address_futures], [f.result() for f in data_futures]
+
+    def _write_address_and_data_registers(
+        self, address_contents: List[int], data_contents: List[int]
+    ):
+        with self.pipeline():
+            for i, value in enumerate(address_contents):
+                self.write_address_register(i, value)
+            for i, value in enumerate(data_contents):
+                self.write_data_register(i, value)
+
     def consistency_check(self):
         """
         Perform a consistency check on the attached Coldfire by reading and
@@ -306,13 +1037,10 @@ class BDMCommandInterface:
         values stick. This will raise a ValueError if any communication or
         consistency errors are detected.
         """
-        address_contents = [self.read_address_register(i) for i in range(NUM_ADDRESS_REGISTERS)]
-        data_contents = [self.read_data_register(i) for i in range(NUM_DATA_REGISTERS)]
+        address_contents, data_contents = self._read_address_and_data_registers()
 
         # Read the address and data registers again and ensure consistency:
-        address_contents_again = [
-            self.read_address_register(i) for i in range(NUM_ADDRESS_REGISTERS)
-        ]
+        address_contents_again, data_contents_again = self._read_address_and_data_registers()
         if address_contents_again != address_contents:
             raise ValueError(
                 f"Read all {NUM_ADDRESS_REGISTERS} address registers twice in a row, but found"
@@ -322,7 +1050,6 @@ class BDMCommandInterface:
                 f" {format_hex_list(address_contents)}, second read resulted in:"
                 f" {format_hex_list(address_contents_again)}"
             )
-        data_contents_again = [self.read_data_register(i) for i in range(NUM_DATA_REGISTERS)]
         if data_contents_again != data_contents:
             raise ValueError(
                 f"Read all {NUM_DATA_REGISTERS} data registers twice in a row, but found different"
@@ -334,21 +1061,14 @@ class BDMCommandInterface:
             )
 
         # Write new random values to the address and data registers:
-        expected_address_contents = [
-            int(random.random() * 0xFFFFFFFF) for _ in range(NUM_ADDRESS_REGISTERS)
-        ]
-        expected_data_contents = [
-            int(random.random() * 0xFFFFFFFF) for _ in range(NUM_DATA_REGISTERS)
-        ]
-        for i, value in enumerate(expected_address_contents):
-            self.write_address_register(i, value)
-        for i, value in enumerate(expected_data_contents):
-            self.write_data_register(i, value)
+        num_registers = NUM_ADDRESS_REGISTERS + NUM_DATA_REGISTERS
+        values = struct.unpack(f">{num_registers}I", os.urandom(num_registers * 4))
+        expected_address_contents = list(values[:NUM_ADDRESS_REGISTERS])
+        expected_data_contents = list(values[NUM_ADDRESS_REGISTERS:])
+        self._write_address_and_data_registers(expected_address_contents, expected_data_contents)
 
         # Check to ensure that the values "stuck":
-        address_contents_again = [
-            self.read_address_register(i) for i in range(NUM_ADDRESS_REGISTERS)
-        ]
+        address_contents_again, data_contents_again = self._read_address_and_data_registers()
         if address_contents_again != expected_address_contents:
             raise ValueError(
                 f"Wrote to all {NUM_ADDRESS_REGISTERS} address registers, but read different"
@@ -358,7 +1078,6 @@ class BDMCommandInterface:
                 f" {format_hex_list(expected_address_contents)}, but read-back resulted in:"
                 f" {format_hex_list(address_contents_again)}"
             )
-        data_contents_again = [self.read_data_register(i) for i in range(NUM_DATA_REGISTERS)]
         if data_contents_again != expected_data_contents:
             raise ValueError(
                 f"Wrote to all {NUM_DATA_REGISTERS} data registers twice in a row, but read"
@@ -370,7 +1089,4 @@ class BDMCommandInterface:
             )
 
         # Write the original values back to the processor to be a nice person:
-        for i, value in enumerate(address_contents):
-            self.write_address_register(i, value)
-        for i, value in enumerate(data_contents):
-            self.write_data_register(i, value)
+        self._write_address_and_data_registers(address_contents, data_contents)
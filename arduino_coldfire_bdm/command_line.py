@@ -1,21 +1,62 @@
+import os
 import sys
+import mmap
+import struct
 import argparse
-from contextlib import nullcontext
+from contextlib import nullcontext, suppress
 import serial
 import time
 from tqdm import tqdm
 
 from arduino_coldfire_bdm.serial_interface import (
     ColdfireSerialInterface,
+    MemoryTestPattern,
     MockColdfireSerialInterface,
+    ThreadedColdfireSerialInterface,
 )
-from arduino_coldfire_bdm.bdm_interface import BDMCommandInterface
+from arduino_coldfire_bdm.bdm_interface import BDMCommandInterface, DUMP_CHUNK_SIZE_WORDS
 from arduino_coldfire_bdm.control_registers import ControlRegisters
 
 
 PADDR_OFFSET = 0x244
 PADAT_OFFSET = 0x248
 
+# MBAR is rarely changed by running code, so while tracing, it's only re-read this often:
+MBAR_REFRESH_INTERVAL_INSTRUCTIONS = 1024
+
+# Raw dumps are read and written to their output in blocks of this many bytes:
+RAW_DUMP_WRITE_SIZE = 1 << 16
+
+# The number of words at the start of Flash memory checked after erasing it:
+ERASE_CHECK_NUM_WORDS = 0x800
+
+# The binary representation of every possible byte, followed by a space:
+BIN8 = tuple([f"{b:08b} " for b in range(256)])
+
+
+def dump_memory_in_chunks(bdm, base: int, length_in_bytes: int, chunk_size: int):
+    """
+    Yield the contents of memory (rounded down to a whole number of words)
+    as `bytes` objects of up to `chunk_size` bytes each.
+    """
+    end = length_in_bytes - (length_in_bytes % 2)
+    for chunk_start in range(0, end, chunk_size):
+        num_bytes = min(chunk_size, end - chunk_start)
+        yield bdm.dump_words_bulk(base + chunk_start, num_bytes // 2)
+
+
+def format_line(line: bytes, binary: bool) -> str:
+    # Each group of four bytes (two words) is followed by a space:
+    if binary:
+        groups = ["".join([BIN8[b] for b in line[i : i + 4]]) for i in range(0, len(line), 4)]
+    else:
+        digits = line.hex()
+        groups = [digits[i : i + 8] for i in range(0, len(digits), 8)]
+    formatted = " ".join(groups)
+    if len(line) % 4 == 0:
+        formatted += " "
+    return formatted
+
 
 def dump_memory_to_ascii(
     bdm,
@@ -25,22 +66,25 @@ def dump_memory_to_ascii(
     words_per_line: int = 8,
     binary: bool = False,
 ):
-    for i, word in enumerate(bdm.dump_words(base, length_in_bytes // 2)):
-        try:
-            address = base + (i * 2)
-            if (address - base) % (words_per_line * 4) == 0:
-                if address > base:
-                    ofile.write("\n")
-                ofile.write(f"0x{address:08x}: ")
-            if binary:
-                ofile.write(f"{word >> 8:08b} {word & 0xFF:08b} ")
-            else:
-                ofile.write(f"{word:04x}")
-            if ((address - base) + 2) % 4 == 0:
-                ofile.write(f" ")
-        except KeyboardInterrupt:
-            ofile.write("\n")
-            break
+    bytes_per_line = words_per_line * 4
+    # Read and format whole lines at a time, writing each chunk of lines at once:
+    chunk_size = max(1, (DUMP_CHUNK_SIZE_WORDS * 2) // bytes_per_line) * bytes_per_line
+    try:
+        chunk_start = 0
+        for chunk in dump_memory_in_chunks(bdm, base, length_in_bytes, chunk_size):
+            # Format the address of every line in the chunk at once, as with the data:
+            addresses = range(base + chunk_start, base + chunk_start + len(chunk), bytes_per_line)
+            address_digits = struct.pack(f">{len(addresses)}I", *addresses).hex()
+            lines = []
+            for i, line_start in enumerate(range(0, len(chunk), bytes_per_line)):
+                if chunk_start + line_start:
+                    lines.append("\n")
+                lines.append("0x" + address_digits[i * 8 : i * 8 + 8] + ": ")
+                lines.append(format_line(chunk[line_start : line_start + bytes_per_line], binary))
+            ofile.write("".join(lines))
+            chunk_start += len(chunk)
+    except KeyboardInterrupt:
+        ofile.write("\n")
     print()
 
 
@@ -73,9 +117,12 @@ def register_dump_command(subparsers):
             else:
                 ofile = open(args.output_filename, "w")
         if args.output_format == "raw":
-            for word in bdm.dump_words(args.starting_address, args.num_bytes // 2):
-                ofile.write((word >> 8).to_bytes(1, byteorder="big"))
-                ofile.write((word & 0xFF).to_bytes(1, byteorder="big"))
+            # Memory is read as big-endian bytes already, so each chunk is written as-is:
+            for chunk in dump_memory_in_chunks(
+                bdm, args.starting_address, args.num_bytes, RAW_DUMP_WRITE_SIZE
+            ):
+                ofile.write(chunk)
+            ofile.flush()
         else:
             dump_memory_to_ascii(
                 bdm,
@@ -129,29 +176,29 @@ def register_trace_command(subparsers):
                 + ["MBAR      ", "PADDR     ", "PADAT     "]
             )
         )
-        for _ in range(0, args.num_instructions):
+        snapshot = bdm.read_registers()
+        for i in range(0, args.num_instructions):
             try:
-                pc = bdm.read_control_register(ControlRegisters.PC)
-                sp = bdm.read_address_register(7)
-                data_registers = [bdm.read_data_register(i) for i in range(4)]
-                address_registers = [bdm.read_address_register(i) for i in range(4)]
-                mbar = bdm.read_control_register(ControlRegisters.MBAR)
+                pc = snapshot.pc
+                if i % MBAR_REFRESH_INTERVAL_INSTRUCTIONS == 0:
+                    mbar = bdm.read_control_register(ControlRegisters.MBAR)
+                    paddr_address = (mbar & 0xFFFFFFFE) + PADDR_OFFSET
+                    padat_address = (mbar & 0xFFFFFFFE) + PADAT_OFFSET
+                with bdm.pipeline():
+                    paddr = bdm.read_word(paddr_address)
+                    padat = bdm.read_word(padat_address)
 
                 values = (
-                    [pc, sp]
-                    + data_registers
-                    + address_registers
-                    + [
-                        mbar,
-                        bdm.read_word((mbar & 0xFFFFFFFE) + PADDR_OFFSET),
-                        bdm.read_word((mbar & 0xFFFFFFFE) + PADAT_OFFSET),
-                    ]
+                    [pc, snapshot.sp]
+                    + list(snapshot.data_registers[:4])
+                    + list(snapshot.address_registers[:4])
+                    + [mbar, paddr.result(), padat.result()]
                 )
                 print("\t".join([f"0x{v:08x}" for v in values]))
                 if pc == 0x0 and args.stop_on_zero:
                     print(f"Program counter is 0; exiting, the processor has probably crashed.")
                     break
-                bdm.step()
+                snapshot = bdm.step_and_snapshot()
             except KeyboardInterrupt:
                 break
 
@@ -185,7 +232,11 @@ def register_load_command(subparsers):
     def load(args, bdm):
         start = time.time()
         with open(args.input_file, "rb") as f:
-            data = f.read()
+            # Map the file rather than reading it, so that slicing it doesn't copy it:
+            if os.fstat(f.fileno()).st_size:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                data = memoryview(b"")
             print(f"Read {len(data):,} bytes from {args.input_file} to load into Flash.")
             if args.max_bytes < len(data):
                 if args.max_bytes % 2 == 1:
@@ -195,28 +246,30 @@ def register_load_command(subparsers):
                     )
                 data = data[: args.max_bytes]
                 print(f"Only loading the first {args.max_bytes:,} bytes.")
+            if len(data) % 2:
+                # Flash is written a word at a time; pad with the erased value of Flash.
+                data = memoryview(bytes(data) + b"\xff")
 
         if not args.skip_erase:
             print("Sending full chip erase...")
             bdm.send_flash_chip_erase()
             print("Testing that chip was erased...")
-            words = [(i, bdm.read_word(i)) for i in range(0, 16, 2)]
-            if not all([word == 0xFFFF for _, word in words]):
+            if not bdm.verify_pattern(0, ERASE_CHECK_NUM_WORDS, 0xFFFF):
+                words = list(bdm.dump_words(0, 8))
                 raise RuntimeError(
-                    "Flash chip was not erased! Expected all words to be 0xFFFF, but the first 8"
-                    f" were: {[word for _, word in words]}"
+                    f"Flash chip was not erased! Expected the first {ERASE_CHECK_NUM_WORDS:,}"
+                    f" words to be 0xFFFF, but the first 8 were: {words}"
                 )
         else:
             print(f"Skipping full chip erase.")
 
         print(f"Unlocking Flash for writing...")
-        bdm.send_flash_unlock_bypass()
+        bdm.enter_flash_unlock_bypass()
         try:
-            with tqdm(total=len(data), unit_scale=True, unit="b") as pbar:
-                for i in range(0, len(data), 2):
-                    v = (data[i] << 8) | data[i + 1]
-                    bdm.send_unlock_bypassed_flash_write(i, v)
-                    pbar.update(2)
+            with tqdm(
+                total=len(data), unit_scale=True, unit="b", mininterval=0.5, miniters=1 << 14
+            ) as pbar:
+                bdm.flash_write_bulk(0, data, on_progress=pbar.update)
         finally:
             print(f"Locking Flash to prevent unexpected writes...")
             bdm.exit_flash_unlock_bypass()
@@ -246,6 +299,21 @@ def register_sram_test_command(subparsers):
         default=0x100000,
         help="The maximum number of bytes to test.",
     )
+    subparser.add_argument(
+        "--pattern",
+        choices=[pattern.name.lower() for pattern in MemoryTestPattern],
+        default=MemoryTestPattern.ADDRESS.name.lower(),
+        help=(
+            "The value to write to each longword: its own address, the value of --pattern-value,"
+            " or the value of --pattern-value rotated left by one bit per longword."
+        ),
+    )
+    subparser.add_argument(
+        "--pattern-value",
+        type=lambda s: int(s, 0),
+        default=0x1,
+        help="The value used by the 'constant' and 'rotated' patterns.",
+    )
 
     def test(args, bdm):
         base = args.base_address
@@ -280,20 +348,20 @@ def register_sram_test_command(subparsers):
                 )
         print(f"SRAM appears to retain values properly.")
 
+        pattern = MemoryTestPattern[args.pattern.upper()]
         print(
             f"Testing RAM from 0x{base:08x} to 0x{end:08x} ({end-base:,} bytes) by writing"
-            " low byte of address to each position."
+            f" the {args.pattern} pattern to each longword."
         )
 
-        for address in range(base, end, 4):
-            value = address
-            bdm.write_longword(address, value)
-            saved_value = bdm.read_longword(address)
-            if saved_value != value:
-                raise ValueError(
-                    f"SRAM check failed! Wrote 0x{value:08x} to 0x{address:08x}, but read back"
-                    f" 0x{saved_value:08x}! This may indicate that SRAM is faulty."
-                )
+        failure = bdm.test_memory(base, end, pattern, args.pattern_value)
+        if failure is not None:
+            address, saved_value = failure
+            expected = pattern.expected_value(address, args.pattern_value)
+            raise ValueError(
+                f"SRAM check failed! Wrote 0x{expected:08x} to 0x{address:08x}, but read back"
+                f" 0x{saved_value:08x}! This may indicate that SRAM is faulty."
+            )
         print(f"SRAM test passed!")
 
     subparser.set_defaults(func=test)
@@ -324,6 +392,23 @@ def main():
         default=None,
         help="The file path of the serial port to connect to.",
     )
+    parser.add_argument(
+        "--skip-consistency-check",
+        action="store_true",
+        help=(
+            "If passed, don't check that the registers of the attached Coldfire processor can be"
+            " read and written before running the command. Saves a little time when running many"
+            " commands against a board that's known to be connected properly."
+        ),
+    )
+    parser.add_argument(
+        "--threaded-io",
+        action="store_true",
+        help=(
+            "If passed, write commands to and read responses from the Arduino on background"
+            " threads, so that the serial port is kept busy in both directions at once."
+        ),
+    )
     parser.add_argument(
         "--baud-rate",
         type=int,
@@ -354,21 +439,35 @@ def main():
     with context as ser:
         if args.dry_run:
             interface = MockColdfireSerialInterface()
+        elif args.threaded_io:
+            interface = ThreadedColdfireSerialInterface(ser)
         else:
             interface = ColdfireSerialInterface(ser)
         bdm = BDMCommandInterface(interface)
 
-        print(f"Entering debug mode...")
-        interface.enter_debug_mode(True)
+        try:
+            print(f"Entering debug mode...")
+            interface.enter_debug_mode(True)
 
-        if not args.dry_run:
-            print(f"Performing consistency check on attached Coldfire processor...")
-            bdm.consistency_check()
+            if not args.dry_run and not args.skip_consistency_check:
+                print(f"Performing consistency check on attached Coldfire processor...")
+                bdm.consistency_check()
 
-        if not hasattr(args, "func"):
-            print("No command provided; doing nothing. (Pass -h to see available commands.)")
+            if not hasattr(args, "func"):
+                print("No command provided; doing nothing. (Pass -h to see available commands.)")
+            else:
+                args.func(args, bdm)
+        except BaseException:
+            # Still send any writes that were deferred (including those made while cleaning
+            # up after the error), without letting their errors hide the original one:
+            with suppress(Exception):
+                bdm.flush()
+            raise
         else:
-            args.func(args, bdm)
+            bdm.flush()
+        finally:
+            if isinstance(interface, ThreadedColdfireSerialInterface):
+                interface.close()
 
     if args.dry_run and args.show_commands:
         print(f"Commands sent to Arduino:")
@@ -1,4 +1,7 @@
-class ControlRegisters:
+from enum import IntEnum
+
+
+class ControlRegisters(IntEnum):
     CACR = 0x0002
     CacheControlRegister = 0x0002
 
@@ -1,6 +1,12 @@
 import os
+import queue
 import serial
 import struct
+import threading
+from collections import deque
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Sequence
 
 PATH_TO_ARDUINO_SKETCH = os.path.join(os.path.dirname(__file__), "arduino-coldfire-bdm.ino")
 
@@ -11,6 +17,82 @@ DEBUG_MESSAGE = (
     " re-uploading with the Arduino IDE."
 )
 
+# The Arduino's hardware serial receive buffer is only 64 bytes long (and as it's a ring
+# buffer, it can only hold 63 bytes at once), and the sketch has no flow control; if we
+# send more than this without waiting for the Arduino to respond, bytes will be silently
+# dropped.
+ARDUINO_RX_BUFFER_SIZE = 64 - 1
+
+# The size of the serial driver's buffers to request, where supported (i.e.: on Windows):
+SERIAL_BUFFER_SIZE = 1 << 20
+
+# Precompiled formats for messages to the Arduino: a command character followed by
+# one 16-bit packet, or by a packet count and the first packet of a multi-packet
+# message, or by the two 32-bit masks of a CSR read-modify-write.
+COMMAND_AND_PACKET = struct.Struct(">cH")
+MULTIPLE_PACKETS_HEADER = struct.Struct(">cBH")
+CSR_READ_MODIFY_WRITE = struct.Struct(">cII")
+
+# Responses from the Arduino are a status character ("Y" if the status bit is set,
+# otherwise "N") followed by the little-endian 16-bit data word.
+RESPONSE_DATA = struct.Struct("<H")
+STATUS_BIT_SET = ord("Y")
+
+# Newer versions of the Arduino sketch support extra commands, each identified by a
+# single character and listed on the sketch's "Ready" line at startup:
+#   M: send multiple packets (i.e.: a command and its operands) in a single message,
+#      receiving a single response.
+#   C: read-modify-write the debug CSR (configuration/status register) in one message.
+#   W: write consecutive words to a Flash chip in unlock bypass mode in one message.
+#   F: as with W, but waiting for the Flash chip to finish programming each word.
+#   D: read consecutive words from memory in one message.
+#   A: as with D, but returning only the data of each word, rather than a full response.
+#   V: check that consecutive words of memory match a pattern, without returning them.
+#   T: test a range of RAM by writing each longword's address to it and reading it back.
+#   G: as with T, but writing a pattern generated by the Arduino (see MemoryTestPattern).
+#   X: execute one instruction, then read the program counter and all registers.
+EXTENSION_MULTIPLE_PACKETS = "M"
+EXTENSION_CSR_READ_MODIFY_WRITE = "C"
+EXTENSION_FLASH_WRITE = "W"
+EXTENSION_FLASH_PROGRAM = "F"
+EXTENSION_READ_WORDS = "D"
+EXTENSION_READ_PACKED_WORDS = "A"
+EXTENSION_VERIFY_WORDS = "V"
+EXTENSION_TEST_MEMORY = "T"
+EXTENSION_TEST_MEMORY_PATTERN = "G"
+EXTENSION_STEP_AND_SNAPSHOT = "X"
+
+# The maximum number of words to send in one "W" (or "F") message. The Arduino takes much
+# longer to write each word than it takes to receive it, so this is small enough that two
+# messages fit into its receive buffer; the next message arrives while one is written.
+FLASH_WRITE_HEADER = struct.Struct(">cIB")
+MAX_FLASH_WRITE_WORDS = ((ARDUINO_RX_BUFFER_SIZE // 2) - FLASH_WRITE_HEADER.size) // 2
+
+READ_WORDS_HEADER = struct.Struct(">cIH")
+VERIFY_WORDS_HEADER = struct.Struct(">cIHH")
+TEST_MEMORY_HEADER = struct.Struct(">cII")
+TEST_MEMORY_PATTERN_HEADER = struct.Struct(">cIIBI")
+MAX_READ_WORDS = 0xFFFF
+
+
+class MemoryTestPattern(IntEnum):
+    """
+    The values that memory tests write to each longword, given its address and a
+    32-bit `pattern_value`. These match the pattern numbers used by the "G" command.
+    """
+
+    ADDRESS = 0  # The longword's own address (as with the "T" command)
+    CONSTANT = 1  # `pattern_value` itself
+    ROTATED = 2  # `pattern_value`, rotated left by one bit per longword (i.e.: walking ones)
+
+    def expected_value(self, address: int, pattern_value: int) -> int:
+        if self == MemoryTestPattern.ADDRESS:
+            return address
+        if self == MemoryTestPattern.CONSTANT:
+            return pattern_value
+        shift = (address >> 2) & 31
+        return ((pattern_value << shift) | (pattern_value >> (32 - shift))) & 0xFFFFFFFF
+
 
 class Response:
     """
@@ -40,6 +122,19 @@ class ColdfireSerialInterface:
         see arduino-coldfire-bdm.ino for the Arduino sketch to upload.
         """
         self.serial = serial
+        self._configure_serial_port()
+
+        # (size in bytes, size of response in bytes) tuples for
+        # deferred commands whose responses haven't been read yet:
+        self._in_flight = deque()
+        self._bytes_in_flight = 0
+        # Raw responses to deferred commands that were read early to make room:
+        self._early_responses = deque()
+        # Bytes sent with `send_packet`, which the Arduino doesn't respond to; these
+        # are counted as in-flight along with the next command that does get a response.
+        self._bytes_without_response = 0
+        # Commands waiting to be written to the serial port; see `flush_tx`.
+        self._tx_buffer = bytearray()
 
         first_line = self.serial.readline().decode("utf-8").strip()
         if not "Motorola Coldfire Debug Interface" in first_line:
@@ -53,10 +148,47 @@ class ColdfireSerialInterface:
                 "Tried to connect to Arduino, but got unexpected second line:"
                 f" {second_line}\n{DEBUG_MESSAGE}"
             )
+        # Older versions of the Arduino sketch don't list any extensions:
+        self.extensions = set(second_line.partition("Extensions:")[2].strip())
+
+    def _configure_serial_port(self):
+        # Some USB serial adapters (i.e.: FTDI chips) wait up to 16ms before passing on
+        # received data, which would dominate the time taken by each round-trip to the
+        # Arduino. On Linux, the driver can be asked not to (as with `setserial low_latency`):
+        try:
+            self.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            pass
+        # On Windows, the driver's buffers can be enlarged, so that long responses
+        # (i.e.: from memory dumps) don't have to be read from the port as quickly:
+        try:
+            self.serial.set_buffer_size(rx_size=SERIAL_BUFFER_SIZE, tx_size=SERIAL_BUFFER_SIZE)
+        except (AttributeError, ValueError, serial.SerialException):
+            pass
+        # No read timeout is set, as some commands (i.e.: "T") legitimately take
+        # several seconds to respond, and pySerial returns partial data on timeout.
+
+    def _write(self, payload: bytes):
+        # Buffer up small writes to send them to the serial port together, but never
+        # more at once than the Arduino can buffer (as it has no flow control).
+        if len(self._tx_buffer) + len(payload) > ARDUINO_RX_BUFFER_SIZE:
+            self.flush_tx()
+        self._tx_buffer += payload
+
+    def flush_tx(self):
+        """
+        Write any buffered commands to the serial port. Commands are buffered to send
+        them in as few writes (and system calls) as possible; this is called automatically
+        before reading any responses.
+        """
+        if self._tx_buffer:
+            self.serial.write(self._tx_buffer)
+            self._tx_buffer.clear()
 
     def test_connection(self):
-        self.serial.write(b"P")
-        response = self.serial.read(4)
+        self._write(b"P")
+        self.flush_tx()
+        response = self.serial.readline().strip()
         if response != b"PONG":
             raise RuntimeError(
                 "Sent ping to Arduino and expected to receive PONG, but got"
@@ -68,7 +200,23 @@ class ColdfireSerialInterface:
         Send a 16-bit data packet to the attached Coldfire BDM via an Arduino bridge.
         The response will not be read automatically; use `receive_packet` to get the subsequent response.
         """
-        self.serial.write(b"s" + struct.pack(">H", data))
+        self._write(COMMAND_AND_PACKET.pack(b"s", data))
+        self._bytes_without_response += 3
+
+    def send_packets(self, packets: Sequence[int]):
+        """
+        Like `send_packet`, but sending each of `packets` in turn with a single write.
+        """
+        payload = self._pack_send_only_packets(packets)
+        self._write(payload)
+        self._bytes_without_response += len(payload)
+
+    @staticmethod
+    def _pack_send_only_packets(packets: Sequence[int]) -> bytearray:
+        payload = bytearray(COMMAND_AND_PACKET.size * len(packets))
+        for i, packet in enumerate(packets):
+            COMMAND_AND_PACKET.pack_into(payload, i * COMMAND_AND_PACKET.size, b"s", packet)
+        return payload
 
     def receive_packet(self) -> Response:
         """
@@ -78,17 +226,312 @@ class ColdfireSerialInterface:
         send_and_receive_packet to send a packet while receiving the response from the
         last packet.
         """
-        self.serial.write(b"r")
+        self._write(b"r")
         return self._receive_packet()
 
     def _receive_packet(self) -> Response:
-        response = self.serial.read(3)
+        self.flush_tx()
+        # Any responses to deferred commands will arrive before ours:
+        while self._in_flight:
+            self._early_responses.append(self._read_in_flight_response())
+        return self._decode_response(self.serial.read(3))
+
+    def _read_in_flight_response(self) -> bytes:
+        return self._read_in_flight_responses(1)
+
+    def _read_in_flight_responses(self, count: int) -> bytes:
+        # Read the raw responses to the oldest `count` deferred commands in one go:
+        self.flush_tx()
+        response_size = 0
+        for _ in range(count):
+            num_bytes, num_response_bytes = self._in_flight.popleft()
+            self._bytes_in_flight -= num_bytes
+            response_size += num_response_bytes
+        return self.serial.read(response_size)
+
+    def _decode_response(self, response: bytes) -> Response:
         # The Arduino serial bridge translates the 17-bit packet into
         # 24 bits for us: 8 bits for the status bit, and then the original
         # 16 bits of the data word.
-        status = int(response[0] == b"N")
-        data = struct.unpack("<H", response[1:])[0]
-        return Response(status, data)
+        status = int(response[0] == STATUS_BIT_SET)
+        (data,) = RESPONSE_DATA.unpack_from(response, 1)
+        decoded = Response(status, data)
+        # If this is a response to multiple packets, decode the
+        # rest too, so that any errors they contain are raised:
+        if len(response) > 3:
+            self._decode_response(response[3:])
+        return decoded
+
+    def _write_deferred(self, payload: bytes, response_size: int = 3):
+        # Avoid overflowing the Arduino's receive buffer by reading (and holding onto)
+        # responses to earlier commands until there's room for this one.
+        size = self._bytes_without_response + len(payload)
+        while self._in_flight and self._bytes_in_flight + size > ARDUINO_RX_BUFFER_SIZE:
+            self._early_responses.append(self._read_in_flight_response())
+        self._write(payload)
+        self._bytes_without_response = 0
+        self._in_flight.append((size, response_size))
+        self._bytes_in_flight += size
+
+    def _expect_further_responses(self, count: int):
+        # For commands that return `count` more responses after the first:
+        self._in_flight.extend([(0, 3)] * count)
+
+    def send_command_deferred(self, packets: Sequence[int], operands: bytes = b""):
+        """
+        Send a BDM command (a sequence of 16-bit packets, i.e.: a command word followed
+        by any address or data operands) to the attached Coldfire in a single message,
+        without waiting for a response. A single response will be returned by a later call
+        to `read_deferred_response`: the response to the first packet, or the first error
+        encountered while sending the rest of the packets.
+
+        Further packets may be passed in `operands` as big-endian bytes (i.e.: as packed
+        by `struct.pack(">I", address)`), to be sent after `packets`.
+        """
+        if len(packets) > 1:
+            operands = struct.pack(f">{len(packets) - 1}H", *packets[1:]) + operands
+        self.send_frame_deferred(self.frame(packets[0], len(operands)), operands)
+
+    def frame(self, command: int, operand_size: int = 0) -> bytes:
+        """
+        Encode the message that sends the 16-bit `command`, to be followed by `operand_size`
+        bytes of operands. This depends only on the command and the size of its operands,
+        so callers sending the same command many times can encode it once and pass the
+        result (with each command's operands) to `send_frame_deferred`.
+        """
+        if operand_size and EXTENSION_MULTIPLE_PACKETS in self.extensions:
+            return MULTIPLE_PACKETS_HEADER.pack(b"M", 1 + (operand_size // 2), command)
+        return COMMAND_AND_PACKET.pack(b"S", command)
+
+    def send_frame_deferred(self, frame: bytes, operands: bytes = b""):
+        """
+        Like `send_command_deferred`, but sending a message encoded by `frame`,
+        followed by `operands` as big-endian bytes.
+        """
+        if not operands or frame.startswith(b"M"):
+            self._write_deferred(frame + operands)
+        else:
+            # Older sketches need each operand packet to be sent separately:
+            self._write_deferred(
+                frame + b"".join([b"S" + operands[i : i + 2] for i in range(0, len(operands), 2)]),
+                3 * (1 + (len(operands) // 2)),
+            )
+
+    def send_and_receive_packet_deferred(self, data: int):
+        """
+        Like `send_and_receive_packet`, but without waiting for the response; instead,
+        the response will be returned by a later call to `read_deferred_response`.
+        This allows sending many commands back-to-back without waiting for a round-trip
+        between each.
+        """
+        self._write_deferred(COMMAND_AND_PACKET.pack(b"S", data))
+
+    def receive_packet_deferred(self):
+        """
+        Like `receive_packet`, but without waiting for the response; instead,
+        the response will be returned by a later call to `read_deferred_response`.
+        """
+        self._write_deferred(b"r")
+
+    def send_and_receive_packets_deferred(self, packets: Sequence[int]):
+        """
+        Equivalent to calling `send_and_receive_packet_deferred` for each of the given
+        packets (each of which will have its own response), but much faster for large
+        numbers of packets, as they're framed together and sent in as few writes as
+        possible. A packet of 0x0000 (a no-op) is sent as a (shorter) receive command.
+        """
+        for packet in packets:
+            self._write_deferred(b"r" if packet == 0 else COMMAND_AND_PACKET.pack(b"S", packet))
+
+    def read_modify_write_csr_deferred(self, and_mask: int, or_mask: int):
+        """
+        Have the Arduino read the debug CSR, set it to `(csr & and_mask) | or_mask`, and
+        write it back, without waiting for a round-trip between the read and the write.
+        A single response will be returned by a later call to `read_deferred_response`,
+        as with `send_command_deferred`.
+
+        Only available if `EXTENSION_CSR_READ_MODIFY_WRITE` is in `self.extensions`.
+        """
+        self._write_deferred(CSR_READ_MODIFY_WRITE.pack(b"C", and_mask, or_mask))
+
+    def write_flash_words_deferred(self, address: int, data: bytes):
+        """
+        Have the Arduino write `data` (up to `MAX_FLASH_WRITE_WORDS` big-endian words)
+        to a Flash chip in unlock bypass mode, starting at `address`. Each word is
+        preceded by the unlock bypass program command. A single response will be
+        returned by a later call to `read_deferred_response`, as with `send_command_deferred`.
+
+        Only available if `EXTENSION_FLASH_WRITE` is in `self.extensions`.
+        """
+        self._write_deferred(FLASH_WRITE_HEADER.pack(b"W", address, len(data) // 2) + data)
+
+    def program_flash_words_deferred(self, address: int, data: bytes):
+        """
+        Like `write_flash_words_deferred`, but the Arduino polls the Flash chip after
+        writing each word, waiting until the chip has finished programming it. If the
+        chip reports a failure (or takes too long), no further words are written and
+        the response is an error response.
+
+        Only available if `EXTENSION_FLASH_PROGRAM` is in `self.extensions`.
+        """
+        self._write_deferred(FLASH_WRITE_HEADER.pack(b"F", address, len(data) // 2) + data)
+
+    def read_words_deferred(self, address: int, count: int):
+        """
+        Have the Arduino read `count` (between 1 and `MAX_READ_WORDS`) consecutive words
+        from memory starting at `address`, without waiting for a round-trip between each.
+        The response to the read command (as with `send_command_deferred`) will be returned
+        by a later call to `read_deferred_response`, followed by one response per word;
+        use `read_deferred_responses_into` to read the words efficiently.
+
+        Only available if `EXTENSION_READ_WORDS` is in `self.extensions`.
+        """
+        self._write_deferred(READ_WORDS_HEADER.pack(b"D", address, count))
+        self._expect_further_responses(count)
+
+    def read_packed_words_deferred(self, address: int, count: int):
+        """
+        Like `read_words_deferred`, but the Arduino only returns the data of each word,
+        rather than a full response per word, followed by a single response: that of
+        the read command, or the first error encountered while reading. This takes a
+        third less time to send over the serial port. Use `read_deferred_words_into`
+        to read the words, rather than `read_deferred_response`.
+
+        Only available if `EXTENSION_READ_PACKED_WORDS` is in `self.extensions`.
+        """
+        self._write_deferred(READ_WORDS_HEADER.pack(b"A", address, count), (2 * count) + 3)
+
+    def verify_words_deferred(self, address: int, count: int, pattern: int):
+        """
+        Have the Arduino read `count` (between 1 and `MAX_READ_WORDS`) consecutive words
+        from memory starting at `address` and compare each with `pattern`. As with
+        `read_words_deferred`, the response to the read command will be returned by a
+        later call to `read_deferred_response`, followed by one more response whose data
+        is the number of words that didn't match (up to 0xFFFF).
+
+        Only available if `EXTENSION_VERIFY_WORDS` is in `self.extensions`.
+        """
+        self._write_deferred(VERIFY_WORDS_HEADER.pack(b"V", address, count, pattern))
+        self._expect_further_responses(1)
+
+    def test_memory_deferred(self, start_address: int, end_address: int):
+        """
+        Have the Arduino write the address of each longword from `start_address` up to
+        `end_address` to it, then read it back, stopping at the first that doesn't match.
+        The response to the first command sent (as with `send_command_deferred`) will be
+        returned by a later call to `read_deferred_response`, followed by five more: one
+        whose data is 1 if a longword didn't match (otherwise 0), then the address of that
+        longword and the value read from it, as two words each.
+
+        Only available if `EXTENSION_TEST_MEMORY` is in `self.extensions`.
+        """
+        self._write_deferred(TEST_MEMORY_HEADER.pack(b"T", start_address, end_address))
+        self._expect_further_responses(5)
+
+    def test_memory_pattern_deferred(
+        self,
+        start_address: int,
+        end_address: int,
+        pattern: MemoryTestPattern,
+        pattern_value: int = 0,
+    ):
+        """
+        Like `test_memory_deferred`, but writing the value given by `pattern` (and
+        `pattern_value`) to each longword, rather than its address. The Arduino
+        generates each value itself, so none of them are sent over the serial port.
+
+        Only available if `EXTENSION_TEST_MEMORY_PATTERN` is in `self.extensions`.
+        """
+        self._write_deferred(
+            TEST_MEMORY_PATTERN_HEADER.pack(
+                b"G", start_address, end_address, pattern, pattern_value
+            )
+        )
+        self._expect_further_responses(5)
+
+    def step_and_snapshot_deferred(self):
+        """
+        Have the Arduino execute the next instruction (single-step mode must already be
+        enabled), then read the program counter, D0-D7 and A0-A7. The response to the
+        first command sent (as with `send_command_deferred`) will be returned by a later
+        call to `read_deferred_response`, followed by the values read as two words each.
+
+        Only available if `EXTENSION_STEP_AND_SNAPSHOT` is in `self.extensions`.
+        """
+        self._write_deferred(b"X")
+        self._expect_further_responses(2 * 17)
+
+    def read_deferred_response(self) -> Response:
+        """
+        Return the response to the oldest deferred command (sent with
+        `send_and_receive_packet_deferred` or `receive_packet_deferred`)
+        that hasn't been read yet.
+        """
+        if self._early_responses:
+            return self._decode_response(self._early_responses.popleft())
+        if not self._in_flight:
+            raise RuntimeError("No deferred responses are waiting to be read!")
+        return self._decode_response(self._read_in_flight_response())
+
+    def discard_deferred_responses(self, count: int):
+        """
+        Read the responses to the oldest `count` deferred commands (or all of them, if
+        fewer are waiting) and throw them away, without raising any errors they contain.
+        Use this after an error to discard responses that are still in flight, so that
+        later commands don't read them in place of their own.
+        """
+        while count and self._early_responses:
+            self._early_responses.popleft()
+            count -= 1
+        if count and self._in_flight:
+            self._read_in_flight_responses(min(count, len(self._in_flight)))
+
+    def read_deferred_responses_into(self, buffer: bytearray, count: int, offset: int = 0):
+        """
+        Read the responses to the oldest `count` deferred commands, writing their data
+        words (in big-endian order, two bytes per response) into `buffer` starting at
+        `offset`. This is much faster than calling `read_deferred_response` repeatedly,
+        as all of the responses are read from the serial port at once.
+        """
+        if count > len(self._early_responses) + len(self._in_flight):
+            raise RuntimeError(f"Fewer than {count:,} deferred responses are waiting to be read!")
+        raw = bytearray()
+        num_read = 0
+        while self._early_responses and num_read < count:
+            raw += self._early_responses.popleft()
+            num_read += 1
+        raw += self._read_in_flight_responses(count - num_read)
+        if len(raw) != count * 3:
+            raise RuntimeError("Can't read multi-packet responses into a buffer!")
+
+        if STATUS_BIT_SET in raw[0::3]:
+            # At least one response has its status bit set; decode each
+            # individually to raise the appropriate error, if any.
+            for i in range(0, len(raw), 3):
+                self._decode_response(raw[i : i + 3])
+        # Responses are little-endian on the wire; swap each into big-endian order:
+        end = offset + count * 2
+        buffer[offset:end:2] = raw[2::3]
+        buffer[offset + 1 : end : 2] = raw[1::3]
+
+    def read_deferred_words_into(self, buffer: bytearray, count: int, offset: int = 0):
+        """
+        Read the response to the oldest deferred command, which must have been sent by
+        `read_packed_words_deferred` with the same `count`, writing the words read
+        (as big-endian bytes) into `buffer` starting at `offset`. Raises an exception if
+        any of the words couldn't be read.
+        """
+        if self._early_responses:
+            raw = self._early_responses.popleft()
+        elif self._in_flight:
+            raw = self._read_in_flight_response()
+        else:
+            raise RuntimeError("No deferred responses are waiting to be read!")
+        if len(raw) != (count * 2) + 3:
+            raise RuntimeError(f"Expected a response containing {count:,} words!")
+        # The words are sent big-endian already; only the final response needs decoding:
+        buffer[offset : offset + count * 2] = raw[: count * 2]
+        self._decode_response(raw[count * 2 :])
 
     def send_and_receive_packet(self, data: int) -> Response:
         """
@@ -97,7 +540,7 @@ class ColdfireSerialInterface:
         can be used to speed up sequences of commands where the response from the last
         command isn't required before sending the next command.
         """
-        self.serial.write(b"S" + struct.pack(">H", data))
+        self._write(COMMAND_AND_PACKET.pack(b"S", data))
         return self._receive_packet()
 
     def enter_debug_mode(self, reset=False):
@@ -108,10 +551,141 @@ class ColdfireSerialInterface:
         """
         if reset:
             # R for Reset
-            self.serial.write(b"R")
+            self._write(b"R")
         else:
             # B for Breakpoint
-            self.serial.write(b"B")
+            self._write(b"B")
+        self.flush_tx()
+
+
+class ThreadedColdfireSerialInterface(ColdfireSerialInterface):
+    """
+    A ColdfireSerialInterface that performs all serial I/O on two background threads:
+    one writing commands to the Arduino as fast as it can accept them, and one reading
+    responses as soon as they arrive. This means that sending commands never has to
+    wait for responses to be read (or vice versa), keeping the serial link busy in
+    both directions. Call `close` when finished to stop the background threads.
+    """
+
+    def __init__(self, serial: serial.Serial):
+        super().__init__(serial)
+        # (payload, future, response size in bytes) tuples, to be written in order:
+        self._tx_queue = queue.Queue()
+        # (future, response size in bytes, size of the payloads it consumes, exception to raise
+        # instead of returning the response) tuples, for responses to be read in order:
+        self._rx_queue = queue.Queue()
+        self._room_in_flight = threading.Condition()
+        self._writer = threading.Thread(target=self._write_forever, daemon=True)
+        self._reader = threading.Thread(target=self._read_forever, daemon=True)
+        self._writer.start()
+        self._reader.start()
+
+    def close(self):
+        """
+        Stop the background threads, after all previously-sent commands have been written.
+        """
+        self._tx_queue.put(None)
+        self._writer.join()
+        self._reader.join()
+
+    def _write_forever(self):
+        # An exception raised while writing a command with no response, to be raised by
+        # the next command that has a response instead (as nothing waits for the former):
+        error = None
+        while True:
+            item = self._tx_queue.get()
+            if item is None:
+                self._rx_queue.put(None)
+                return
+            payload, future, response_size = item
+            # Avoid overflowing the Arduino's receive buffer (as in `_write_deferred`). Bytes
+            # sent without a response are only known to be consumed once the next command's
+            # response is read, so only wait if some response is still to come:
+            with self._room_in_flight:
+                self._room_in_flight.wait_for(
+                    lambda: self._bytes_in_flight == self._bytes_without_response
+                    or self._bytes_in_flight + len(payload) <= ARDUINO_RX_BUFFER_SIZE
+                )
+                self._bytes_in_flight += len(payload)
+            try:
+                if payload:
+                    self.serial.write(payload)
+            except Exception as e:
+                # Release this command's space, as no response will be read to do so:
+                size = len(payload) + (self._bytes_without_response if response_size else 0)
+                with self._room_in_flight:
+                    self._bytes_in_flight -= size
+                    self._room_in_flight.notify()
+                if response_size:
+                    self._bytes_without_response = 0
+                    error = None
+                else:
+                    error = error or e
+                future.set_exception(e)
+                continue
+            if response_size:
+                size = self._bytes_without_response + len(payload)
+                self._bytes_without_response = 0
+                self._rx_queue.put((future, response_size, size, error))
+                error = None
+            else:
+                self._bytes_without_response += len(payload)
+                future.set_result(b"")
+
+    def _read_forever(self):
+        while True:
+            item = self._rx_queue.get()
+            if item is None:
+                return
+            future, response_size, payload_size, error = item
+            try:
+                # Read the response even if it's to be discarded, to stay in sync:
+                response = self.serial.read(response_size)
+                if error is not None:
+                    raise error
+                future.set_result(response)
+            except Exception as e:
+                future.set_exception(e)
+            with self._room_in_flight:
+                self._bytes_in_flight -= payload_size
+                self._room_in_flight.notify()
+
+    def _submit(self, payload: bytes, response_size: int = 0) -> Future:
+        future = Future()
+        self._tx_queue.put((payload, future, response_size))
+        return future
+
+    def _write_deferred(self, payload: bytes, response_size: int = 3):
+        self._in_flight.append(self._submit(payload, response_size))
+
+    def _expect_further_responses(self, count: int):
+        self._in_flight.extend([self._submit(b"", 3) for _ in range(count)])
+
+    def _read_in_flight_responses(self, count: int) -> bytes:
+        return b"".join([self._in_flight.popleft().result() for _ in range(count)])
+
+    def test_connection(self):
+        response = self._submit(b"P", len(b"PONG\r\n")).result().strip()
+        if response != b"PONG":
+            raise RuntimeError(
+                "Sent ping to Arduino and expected to receive PONG, but got"
+                f" {repr(response)}.\n{DEBUG_MESSAGE}"
+            )
+
+    def send_packet(self, data: int):
+        self._submit(COMMAND_AND_PACKET.pack(b"s", data))
+
+    def send_packets(self, packets: Sequence[int]):
+        self._submit(bytes(self._pack_send_only_packets(packets)))
+
+    def receive_packet(self) -> Response:
+        return self._decode_response(self._submit(b"r", 3).result())
+
+    def send_and_receive_packet(self, data: int) -> Response:
+        return self._decode_response(self._submit(COMMAND_AND_PACKET.pack(b"S", data), 3).result())
+
+    def enter_debug_mode(self, reset=False):
+        self._submit(b"R" if reset else b"B")
 
 
 class MockColdfireSerialInterface:
@@ -120,6 +694,18 @@ class MockColdfireSerialInterface:
         Provide a fake serial interface to use for dry runs and testing.
         """
         self.commands_sent = []
+        self.num_deferred_responses = 0
+        self.extensions = {
+            EXTENSION_MULTIPLE_PACKETS,
+            EXTENSION_CSR_READ_MODIFY_WRITE,
+            EXTENSION_FLASH_WRITE,
+            EXTENSION_FLASH_PROGRAM,
+            EXTENSION_READ_WORDS,
+            EXTENSION_READ_PACKED_WORDS,
+            EXTENSION_STEP_AND_SNAPSHOT,
+            # EXTENSION_VERIFY_WORDS is left out, so that dry runs verify memory
+            # against the data returned by `read_deferred_responses_into` instead.
+        }
 
     def test_connection(self):
         self.commands_sent.append(b"P")
@@ -129,7 +715,11 @@ class MockColdfireSerialInterface:
         Send a 16-bit data packet to the attached Coldfire BDM via an Arduino bridge.
         The response will not be read automatically; use `receive_packet` to get the subsequent response.
         """
-        self.commands_sent.append(b"s" + struct.pack(">H", data))
+        self.commands_sent.append(COMMAND_AND_PACKET.pack(b"s", data))
+
+    def send_packets(self, packets: Sequence[int]):
+        for packet in packets:
+            self.send_packet(packet)
 
     def receive_packet(self) -> Response:
         self.commands_sent.append(b"r")
@@ -139,9 +729,87 @@ class MockColdfireSerialInterface:
         return Response(0, 0xFFFF)
 
     def send_and_receive_packet(self, data: int) -> Response:
-        self.commands_sent.append(b"S" + struct.pack(">H", data))
+        self.commands_sent.append(COMMAND_AND_PACKET.pack(b"S", data))
         return self._receive_packet()
 
+    def send_and_receive_packet_deferred(self, data: int):
+        self.commands_sent.append(COMMAND_AND_PACKET.pack(b"S", data))
+        self.num_deferred_responses += 1
+
+    def receive_packet_deferred(self):
+        self.commands_sent.append(b"r")
+        self.num_deferred_responses += 1
+
+    def send_and_receive_packets_deferred(self, packets: Sequence[int]):
+        for packet in packets:
+            if packet == 0:
+                self.receive_packet_deferred()
+            else:
+                self.send_and_receive_packet_deferred(packet)
+
+    def send_command_deferred(self, packets: Sequence[int], operands: bytes = b""):
+        if len(packets) == 1 and not operands:
+            return self.send_and_receive_packet_deferred(packets[0])
+        num_packets = len(packets) + (len(operands) // 2)
+        self.commands_sent.append(
+            b"M" + struct.pack(f">B{len(packets)}H", num_packets, *packets) + operands
+        )
+        self.num_deferred_responses += 1
+
+    def frame(self, command: int, operand_size: int = 0) -> bytes:
+        if operand_size:
+            return MULTIPLE_PACKETS_HEADER.pack(b"M", 1 + (operand_size // 2), command)
+        return COMMAND_AND_PACKET.pack(b"S", command)
+
+    def send_frame_deferred(self, frame: bytes, operands: bytes = b""):
+        self.commands_sent.append(frame + operands)
+        self.num_deferred_responses += 1
+
+    def read_modify_write_csr_deferred(self, and_mask: int, or_mask: int):
+        self.commands_sent.append(CSR_READ_MODIFY_WRITE.pack(b"C", and_mask, or_mask))
+        self.num_deferred_responses += 1
+
+    def write_flash_words_deferred(self, address: int, data: bytes):
+        self.commands_sent.append(FLASH_WRITE_HEADER.pack(b"W", address, len(data) // 2) + data)
+        self.num_deferred_responses += 1
+
+    def program_flash_words_deferred(self, address: int, data: bytes):
+        self.commands_sent.append(FLASH_WRITE_HEADER.pack(b"F", address, len(data) // 2) + data)
+        self.num_deferred_responses += 1
+
+    def read_words_deferred(self, address: int, count: int):
+        self.commands_sent.append(READ_WORDS_HEADER.pack(b"D", address, count))
+        self.num_deferred_responses += 1 + count
+
+    def read_packed_words_deferred(self, address: int, count: int):
+        self.commands_sent.append(READ_WORDS_HEADER.pack(b"A", address, count))
+        self.num_deferred_responses += 1
+
+    def step_and_snapshot_deferred(self):
+        self.commands_sent.append(b"X")
+        self.num_deferred_responses += 1 + (2 * 17)
+
+    def read_deferred_response(self) -> Response:
+        if not self.num_deferred_responses:
+            raise RuntimeError("No deferred responses are waiting to be read!")
+        self.num_deferred_responses -= 1
+        return self._receive_packet()
+
+    def discard_deferred_responses(self, count: int):
+        self.num_deferred_responses -= min(count, self.num_deferred_responses)
+
+    def read_deferred_responses_into(self, buffer: bytearray, count: int, offset: int = 0):
+        if count > self.num_deferred_responses:
+            raise RuntimeError(f"Fewer than {count:,} deferred responses are waiting to be read!")
+        self.num_deferred_responses -= count
+        buffer[offset : offset + count * 2] = b"\xFF" * (count * 2)
+
+    def read_deferred_words_into(self, buffer: bytearray, count: int, offset: int = 0):
+        if not self.num_deferred_responses:
+            raise RuntimeError("No deferred responses are waiting to be read!")
+        self.num_deferred_responses -= 1
+        buffer[offset : offset + count * 2] = b"\xFF" * (count * 2)
+
     def enter_debug_mode(self, reset=False):
         if reset:
             # R for Reset